@@ -1,59 +1,165 @@
-from typing import List
+"""
+API управления записями хостов.
 
-from fastapi import APIRouter, HTTPException
+Ответ GET /api/v1/hosts кэшируется в сериализованном виде в памяти процесса (all_hosts_cache).
+Кэш сбрасывается только при изменениях через маршруты этого процесса. Изменения, сделанные другим
+процессом (например, другим воркером uvicorn) или напрямую в базе данных, становятся видны в списке хостов
+не позднее чем через ALL_HOSTS_CACHE_TTL секунд. Код, изменяющий таблицу hosts в обход API, при необходимости
+немедленной видимости изменений должен вызвать all_hosts_cache.invalidate().
+Запросы отдельных хостов по идентификатору не кэшируются.
+"""
+
+import time
+from threading import Lock
+from typing import List, Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
 
 from app.models.host import Host
 from app.db.hosts import host_repo
 
 
-hosts_api = APIRouter()
+# Максимальное время в секундах, в течение которого список хостов может не отражать изменения в обход API
+ALL_HOSTS_CACHE_TTL = 5
+
+hosts_api = APIRouter(prefix='/api/v1/hosts')
+_host_adapter = TypeAdapter(Host)
+
+
+class SerializedResponseCache:
+    """
+    Кэш сериализованного тела ответа.
+    Сбрасывается при изменении данных через API, а также по истечении времени жизни,
+    чтобы изменения, сделанные в обход текущего процесса, тоже становились видны.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._lock = Lock()
+        self._version = 0
+        self._content: Optional[bytes] = None
+        self._expires_at = 0.0
+
+    def get(self) -> Tuple[Optional[bytes], int]:
+        """
+        Получение закэшированного тела ответа.
+
+        Returns:
+            Tuple[Optional[bytes], int]: Тело ответа (None, если кэш пуст или устарел)
+                                         и версия кэша, которую необходимо передать в "set"
+        """
+
+        with self._lock:
+            if self._content is not None and time.monotonic() < self._expires_at:
+                return self._content, self._version
+            return None, self._version
+
+    def set(self, content: bytes, version: int):
+        """
+        Сохранение тела ответа в кэш.
+        Если после получения версии кэш был сброшен, то значение не сохраняется,
+        так как оно могло быть построено по устаревшим данным.
+
+        Args:
+            content (bytes): Тело ответа
+            version (int): Версия кэша, полученная из "get" до чтения данных
+        """
+
+        with self._lock:
+            if version == self._version:
+                self._content = content
+                self._expires_at = time.monotonic() + self._ttl
 
+    def invalidate(self):
+        """Сброс кэша."""
 
-@hosts_api.post('/api/v1/hosts')
-def add_host(host: Host):
+        with self._lock:
+            self._version += 1
+            self._content = None
+
+
+all_hosts_cache = SerializedResponseCache(ALL_HOSTS_CACHE_TTL)
+
+
+def _serialize_all_hosts() -> bytes:
+    """
+    Сериализация всех записей хостов в JSON.
+    Хосты сериализуются по одному по мере чтения из базы, без промежуточного списка моделей.
+
+    Returns:
+        bytes: JSON массив хостов
+    """
+
+    return b'[' + b','.join(map(_host_adapter.dump_json, host_repo.get_all_hosts())) + b']'
+
+
+@hosts_api.post('')
+async def add_host(host: Host) -> Dict[str, int]:
     """Добавление новой записи хоста."""
 
-    new_host_id = host_repo.add_host(host)
+    new_host_id = await run_in_threadpool(host_repo.add_host, host)
+    all_hosts_cache.invalidate()
     return {'id': new_host_id}
 
 
-@hosts_api.get('/api/v1/hosts')
-def get_all_hosts() -> List[Host]:
-    """Извлечение всех записей хостов."""
+@hosts_api.post('/bulk')
+async def bulk_add_hosts(new_hosts: List[Host]) -> Dict[str, List[int]]:
+    """Добавление нескольких новых записей хостов одним запросом."""
+
+    new_host_ids = await run_in_threadpool(host_repo.bulk_add_hosts, new_hosts)
+    all_hosts_cache.invalidate()
+    return {'ids': new_host_ids}
+
+
+@hosts_api.get('', response_model=List[Host])
+async def get_all_hosts() -> Response:
+    """
+    Извлечение всех записей хостов.
+    Сериализованный список хостов кэшируется, чтобы не выполнять запрос к базе,
+    валидацию и кодирование в JSON на каждый запрос. Ответ из кэша отдается
+    без переключения в пул потоков.
+    """
 
-    hosts = host_repo.get_all_hosts()
-    return hosts
+    content, version = all_hosts_cache.get()
+    if content is None:
+        content = await run_in_threadpool(_serialize_all_hosts)
+        all_hosts_cache.set(content, version)
+    return Response(content=content, media_type='application/json')
 
 
-@hosts_api.get('/api/v1/hosts/{host_id}')
-def get_host(host_id: int) -> Host:
+@hosts_api.get('/{host_id}')
+async def get_host(host_id: int) -> Host:
     """Извлечение записи хоста по его идентификатору."""
 
     try:
-        host = host_repo.get_host(host_id)
+        host = await run_in_threadpool(host_repo.get_host, host_id)
     except LookupError as err:
         raise HTTPException(status_code=404, detail='Host not found') from err
 
     return host
 
 
-@hosts_api.delete('/api/v1/hosts/{host_id}')
-def delete_host(host_id: int):
+@hosts_api.delete('/{host_id}')
+async def delete_host(host_id: int) -> Dict[str, str]:
     """Удаление записи хоста с указанными идентификатором."""
 
     try:
-        host_repo.delete_host(host_id)
+        await run_in_threadpool(host_repo.delete_host, host_id)
     except LookupError as err:
         raise HTTPException(status_code=404, detail='Host not found') from err
+    all_hosts_cache.invalidate()
     return {'detail': 'Deleted'}
 
 
-@hosts_api.put('/api/v1/hosts/{host_id}')
-def update_host(host: Host, host_id: int):
+@hosts_api.put('/{host_id}')
+async def update_host(host: Host, host_id: int) -> Dict[str, str]:
     """Обновление записи хосте."""
 
     try:
-        host_repo.update_host(host, host_id)
+        await run_in_threadpool(host_repo.update_host, host, host_id)
     except LookupError as err:
         raise HTTPException(status_code=404, detail='Host not found') from err
+    all_hosts_cache.invalidate()
     return {'detail': 'Updated'}
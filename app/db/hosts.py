@@ -1,14 +1,45 @@
 import logging
-from typing import List
+from contextlib import contextmanager
+from typing import List, Generator, Iterator, Dict, Any
 
-from sqlalchemy import create_engine, MetaData, Table, String, Integer, Column
+from sqlalchemy import create_engine, event, MetaData, Table, String, Integer, Column, Connection, bindparam
+from sqlalchemy.pool import QueuePool
 
-from app.singleton import Singleton
 from app.models.host import Host
 
 
+SELECT_ALL_BATCH_SIZE = 500
+
 metadata = MetaData()
-engine = create_engine('sqlite:///test.db')
+engine = create_engine('sqlite:///test.db',
+                       poolclass=QueuePool, pool_size=8, max_overflow=16, pool_pre_ping=False,
+                       # Подключения из пула используются разными потоками обработчиков запросов
+                       connect_args={'check_same_thread': False})
+
+SQLITE_PRAGMAS = (
+    # Журнал упреждающей записи: чтение не блокирует запись, а фиксация транзакции требует меньше fsync
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+)
+
+
+@event.listens_for(engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """
+    Настройка каждого нового подключения к SQLite.
+
+    Args:
+        dbapi_connection: DB-API подключение к базе данных
+        _connection_record: Запись пула подключений
+    """
+
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 
 hosts = Table('hosts', metadata,
               Column('host_id', Integer(), primary_key=True),
@@ -19,18 +50,55 @@ hosts = Table('hosts', metadata,
               Column('username', String(256), nullable=False),
               Column('password', String(256), nullable=False))
 
-metadata.create_all(engine)
+
+def init_db():
+    """Создание таблиц базы данных, если они еще не созданы. Вызывается при запуске приложения."""
+
+    metadata.create_all(engine)
+
+
+def _dirty_dict(host: Host) -> Dict[str, Any]:
+    """
+    Получение словаря явно заданных полей хоста.
+    Аналог host.model_dump(exclude_unset=True) для плоской модели без обхода схемы сериализации.
+
+    Args:
+        host (Host): Хост
+
+    Returns:
+        Dict[str, Any]: Словарь явно заданных полей хоста и их значений
+    """
+
+    return {name: getattr(host, name) for name in host.model_fields_set}
 
 
-class HostRepository(Singleton):
+class HostRepository:
     """
     Класс для выполнения CRUD операций с хостами в базе данных.
-    В классе HostRepository используется паттерн "одиночка",
-    может быть создан только один экземпляр.
+    Единственный используемый экземпляр создается при импорте модуля и доступен как host_repo.
     """
 
     def __init__(self):
         self._logger = logging.getLogger('host_repo')
+        # Запросы строятся один раз, что позволяет SQLAlchemy использовать кэш скомпилированных запросов
+        self._insert_many = hosts.insert().returning(hosts.c.host_id, sort_by_parameter_order=True)
+        self._select_all = hosts.select()
+        self._select_one = hosts.select().where(hosts.c.host_id == bindparam('hid'))
+        self._delete_one = hosts.delete().where(hosts.c.host_id == bindparam('hid'))
+        self._update_one = hosts.update().where(hosts.c.host_id == bindparam('hid'))
+
+    @contextmanager
+    def _connection(self) -> Generator[Connection, None, None]:
+        """
+        Контекстный менеджер подключения к базе данных из пула.
+        При успешном выходе из контекста транзакция фиксируется, а при исключении откатывается.
+
+        Yields:
+            Connection: Подключение к базе данных
+        """
+
+        with engine.begin() as conn:
+            yield conn
 
     def add_host(self, host: Host) -> int:
         """
@@ -43,30 +111,46 @@ class HostRepository(Singleton):
             int: Идентификатор в базе данных добавленого хоста
         """
 
-        self._logger.info(f'Creating a host in the database: {host}')
-        insert_request = hosts.insert().values(
-            **host.model_dump(exclude_unset=True)
-        )
-        with engine.connect() as conn:
-            response = conn.execute(insert_request)
-            host_id = response.inserted_primary_key[0]
-            conn.commit()
-        self._logger.info(f'Created a host in the database: {host_id}')
-        return host_id
+        return self.bulk_add_hosts([host])[0]
 
-    def get_all_hosts(self) -> List[Host]:
+    def bulk_add_hosts(self, new_hosts: List[Host]) -> List[int]:
         """
-        Получить все записи хостов из базы данных.
+        Добавление нескольких хостов в базу данных одним запросом.
+
+        Args:
+            new_hosts (List[Host]): Хосты которые необходимо добавить в базу данных
 
         Returns:
-            List[Host]: Список всех хостов из базы данных
+            List[int]: Идентификаторы добавленных хостов в порядке их передачи
+        """
+
+        if not new_hosts:
+            # Выполнение вставки без параметров добавило бы одну пустую запись
+            return []
+        self._logger.info(f'Creating hosts in the database: {new_hosts}')
+        # Все записи должны иметь одинаковый набор полей, поэтому host_id передается всегда,
+        # при значении None идентификатор назначается базой данных
+        with self._connection() as conn:
+            response = conn.execute(self._insert_many, [host.model_dump() for host in new_hosts])
+            host_ids = list(response.scalars())
+        self._logger.info(f'Created hosts in the database: {host_ids}')
+        return host_ids
+
+    def get_all_hosts(self) -> Iterator[Host]:
+        """
+        Получить все записи хостов из базы данных.
+        Записи извлекаются из базы порциями по мере итерации,
+        подключение освобождается после завершения итерации.
+
+        Yields:
+            Iterator[Host]: Хосты из базы данных
         """
 
         self._logger.info('Retrieving all hosts from the database')
         with engine.connect() as conn:
-            select_request = hosts.select()
-            response = conn.execute(select_request)
-        return [Host.from_orm(data) for data in response.fetchall()]
+            response = conn.execution_options(yield_per=SELECT_ALL_BATCH_SIZE).execute(self._select_all)
+            for data in response.mappings():
+                yield Host.model_validate(data)
 
     def get_host(self, host_id: int) -> Host:
         """
@@ -84,14 +168,11 @@ class HostRepository(Singleton):
 
         self._logger.info(f'Retrieving host by id {host_id}')
         with engine.connect() as conn:
-            select_request = hosts.select().where(
-                hosts.c.host_id == host_id
-            )
-            response = conn.execute(select_request)
-        data = response.first()
+            response = conn.execute(self._select_one, {'hid': host_id})
+        data = response.mappings().first()
         if data is None:
             raise LookupError
-        return Host.from_orm(data)
+        return Host.model_validate(data)
 
     def delete_host(self, host_id: int):
         """
@@ -105,12 +186,8 @@ class HostRepository(Singleton):
         """
 
         self._logger.info(f'Deleting host with id {host_id}')
-        with engine.connect() as conn:
-            delete_request = hosts.delete().where(
-                hosts.c.host_id == host_id
-            )
-            response = conn.execute(delete_request)
-            conn.commit()
+        with self._connection() as conn:
+            response = conn.execute(self._delete_one, {'hid': host_id})
         if response.rowcount == 0:
             raise LookupError
 
@@ -127,14 +204,9 @@ class HostRepository(Singleton):
         """
 
         self._logger.info(f'Updating host with id {host_id}, {host}')
-        with engine.connect() as conn:
-            update_request = hosts.update().where(
-                hosts.c.host_id == host_id
-            ).values(
-                **host.model_dump(exclude_unset=True)
-            )
-            response = conn.execute(update_request)
-            conn.commit()
+        with self._connection() as conn:
+            # Значения обновляемых полей передаются как параметры запроса и попадают в SET
+            response = conn.execute(self._update_one, {'hid': host_id, **_dirty_dict(host)})
         if response.rowcount == 0:
             raise LookupError
 
@@ -1,34 +1,71 @@
+import os
 import logging
-import select
-from typing import Union, Literal
+import selectors
+import socket
+import time
+from contextlib import suppress, contextmanager
+from typing import Union, Literal, Callable, Generator, List, BinaryIO, Optional, Tuple, Dict, Any
 from threading import Thread
 from abc import ABC, abstractmethod
 
-from .ssh_conn_mngr import SSHConnectionManager
+import paramiko
+
+from .ssh_conn_mngr import SSHConnectionManager, SSH_CONNECT_TIMEOUT
+
+
+RECV_BUFFER_SIZE = 256 * 1024
+RECV_STDERR_BUFFER_SIZE = 4 * 1024
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 1
+WRITEV_THRESHOLD = 16 * 1024
+WRITEV_MAX_CHUNKS = 4
+PAGE_CACHE_DROP_WINDOW = 16 * 1024 * 1024
+
+# Сниффер ожидает событий всего от двух дескрипторов, для такого количества poll дешевле epoll:
+# не требуется создание отдельного дескриптора и системные вызовы регистрации
+_Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
 
 
 class DumperError(Exception):
     """Исключение возникающее при ошибке в работе сниффера."""
 
 
+class DumperLoggerAdapter(logging.LoggerAdapter):
+    """
+    Адаптер общего логгера снифферов, добавляющий имя сниффера в начало сообщения
+    и в атрибут "task" лог записи.
+    """
+
+    def process(self, msg, kwargs):
+        msg, kwargs = super().process(msg, kwargs)
+        return f'[{self.extra["task"]}] {msg}', kwargs
+
+
 class Dumper(Thread, ABC):
     """Базовый класс сниффера."""
 
+    # Общий для всех снифферов логгер, чтобы уникальные имена задач не накапливались в таблице логгеров
+    _class_logger = logging.getLogger(__name__)
+
     @property
     @abstractmethod
     def task_type(self) -> Literal['log_dump', 'pcap_dump']:
         """Тип сниффера в текстовом виде."""
 
+    # Выполняемая команда, формируется один раз в конструкторе наследника
+    _executed_command: str
+
     @property
-    @abstractmethod
     def executed_command(self) -> str:
         """Выполняемая команда на удаленном хосте."""
 
+        return self._executed_command
+
     def __init__(self, name: str, address: str, port: Union[str, int],
                  username: str, password: str, output_file: str):
         Thread.__init__(self, name=name, daemon=True)
-        self._logger = logging.getLogger(self.name)
-        self._connection_parameters = {
+        self._logger = DumperLoggerAdapter(self._class_logger, {'task': self.name})
+        self._connection_parameters: Dict[str, Any] = {
             "address": address,
             "port": port,
             "username": username,
@@ -36,58 +73,192 @@ class Dumper(Thread, ABC):
         }
         self._need_stop = False
         self._output_file = output_file
+        self._ssh_lease: Optional[Tuple[str, paramiko.SSHClient]] = None
+        # Пара сокетов для пробуждения потока создается в run, чтобы не запущенный сниффер не удерживал дескрипторы
+        self._wakeup_reader: Optional[socket.socket] = None
+        self._wakeup_writer: Optional[socket.socket] = None
+        # Параметры сниффера не изменяются, поэтому представление объекта формируется один раз
+        self._repr = self._build_repr()
 
     def __repr__(self) -> str:
-        repr_value = f'{self.__class__.__name__}(name={repr(self.name)}'
-        for attr_name in ('address', 'port', 'username', 'password'):
-            attr_value = repr(self._connection_parameters[attr_name])
-            repr_value += f', {attr_name}={attr_value}'
-        repr_value += f', output_file={repr(self._output_file)})'
-        return repr_value
+        return self._repr
+
+    def _build_repr(self, **extra_attrs: Any) -> str:
+        """
+        Формирование строкового представления сниффера.
+
+        Args:
+            **extra_attrs (Any): Дополнительные параметры конкретного сниффера
+
+        Returns:
+            str: Строковое представление сниффера
+        """
+
+        parts = [f'name={self.name!r}']
+        parts.extend(f'{attr_name}={self._connection_parameters[attr_name]!r}'
+                     for attr_name in ('address', 'port', 'username', 'password'))
+        parts.append(f'output_file={self._output_file!r}')
+        parts.extend(f'{attr_name}={attr_value!r}' for attr_name, attr_value in extra_attrs.items())
+        return f'{self.__class__.__name__}({", ".join(parts)})'
 
     def run(self):
         self._logger.info('Starting ...')
-        ssh_manager = SSHConnectionManager(f'{self.name}.ssh_mngr')
-        with ssh_manager.connection(**self._connection_parameters) as ssh, \
-             open(self._output_file, 'wb') as output_file:
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        with self._wakeup_reader, self._wakeup_writer, \
+             self._ssh_connection() as ssh, \
+             open(self._output_file, 'wb', buffering=OUTPUT_BUFFER_SIZE) as output_file, \
+             _Selector() as selector:
             self._logger.info(f'Execute command: {self.executed_command}')
-            _, stdout, stderr = ssh.exec_command(self.executed_command)
+            _, stdout, _ = ssh.exec_command(self.executed_command)
             channel = stdout.channel
 
             if channel.exit_status_ready():
                 exitcode = channel.recv_exit_status()
                 raise DumperError(f'The process terminated early with exit code: {exitcode}')
 
-            file_descriptor = channel.fileno()
-            epoll = select.epoll()
-            epoll.register(file_descriptor, select.EPOLLIN | select.EPOLLHUP)
+            selector.register(channel.fileno(), selectors.EVENT_READ)
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
 
+            if hasattr(os, 'posix_fadvise'):
+                with suppress(OSError):
+                    os.posix_fadvise(output_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            dropped_offset = 0
+            flush_deadline = None
             while self._need_stop is False:
-                for fileno, event in epoll.poll(1):
-                    if fileno != file_descriptor:
-                        self._logger.error(f'Recived epoll data with unknown file descriptor {fileno}')
-                        continue
-                    if event & select.EPOLLIN:
-                        while channel.recv_ready():
-                            data = stdout.read(len(channel.in_buffer))
-                            # self._logger.error(f'Recived new data: {data.decode(encoding="utf8")}')
-                            output_file.write(data)
-                        while channel.recv_stderr_ready():
-                            data = stderr.read(len(channel.in_stderr_buffer))
-                            self._logger.error(f'Recived new err data: {data.decode(encoding="utf8")}')
-                    elif event & select.EPOLLHUP:
-                        self._logger.info('Recive End-Of-Steam, terminate buffer reader')
-                        self._need_stop = True
-                        continue
-                    else:
-                        self._logger.error(f'Recived epoll data with unknown event {event}')
-                        continue
-
-            epoll.unregister(file_descriptor)
-            epoll.close()
+                # Пока в буфере файла нет данных, ждем событий без таймаута
+                timeout = None if flush_deadline is None else max(flush_deadline - time.monotonic(), 0)
+                selector.select(timeout)
+                if flush_deadline is not None and time.monotonic() >= flush_deadline:
+                    output_file.flush()
+                    dropped_offset = self._drop_page_cache(output_file.fileno(), dropped_offset)
+                    flush_deadline = None
+                if channel.recv_ready():
+                    self._write_chunks(output_file, self._recv_chunks(channel.recv_ready, channel.recv))
+                    if flush_deadline is None:
+                        flush_deadline = time.monotonic() + FLUSH_INTERVAL
+                while channel.recv_stderr_ready():
+                    data = channel.recv_stderr(RECV_STDERR_BUFFER_SIZE)
+                    if self._logger.isEnabledFor(logging.ERROR):
+                        self._logger.error('Recived new err data: %s', data.decode(encoding='utf8', errors='replace'))
+                if (channel.eof_received or channel.closed) and not channel.recv_ready():
+                    self._logger.info('Recive End-Of-Steam, terminate buffer reader')
+                    self._need_stop = True
 
+            output_file.flush()
             stdout.channel.close()
 
+    def connect(self, timeout: float = SSH_CONNECT_TIMEOUT):
+        """
+        Предварительное подключение к удаленному хосту в вызывающем потоке.
+        Позволяет получить ошибку подключения до запуска сниффера
+        и не тратить время на установку SSH соединения после запуска.
+
+        Args:
+            timeout (float, optional): Общее время ожидания нового SSH подключения в секундах.
+                                       Defaults to SSH_CONNECT_TIMEOUT.
+        """
+
+        if self._ssh_lease is None:
+            ssh_manager = SSHConnectionManager(f'{self.name}.ssh_mngr')
+            self._ssh_lease = ssh_manager.get_connection(**self._connection_parameters, timeout=timeout)
+
+    @contextmanager
+    def _ssh_connection(self) -> Generator[paramiko.SSHClient, None, None]:
+        """
+        Контекстный менеджер SSH подключения сниффера. Использует подключение,
+        полученное в "connect", либо создает новое, а при выходе из контекста освобождает аренду.
+
+        Yields:
+            paramiko.SSHClient: SSH подключение
+        """
+
+        ssh_manager = SSHConnectionManager(f'{self.name}.ssh_mngr')
+        if self._ssh_lease is None:
+            self._ssh_lease = ssh_manager.get_connection(**self._connection_parameters)
+        lease_id, ssh = self._ssh_lease
+        self._ssh_lease = None
+        try:
+            yield ssh
+        finally:
+            ssh_manager.release_connection(lease_id)
+
+    @staticmethod
+    def _recv_chunks(recv_ready: Callable[[], bool], recv: Callable[[int], bytes]) -> List[bytes]:
+        """
+        Прием блоков данных из SSH канала, пока в канале есть данные, но не более WRITEV_MAX_CHUNKS блоков,
+        чтобы поток успевал обрабатывать stderr и сигнал остановки.
+        paramiko возвращает каждый блок новым объектом bytes, поэтому блоки записываются в файл как есть,
+        без копирования в промежуточный буфер.
+
+        Args:
+            recv_ready (Callable[[], bool]): Функция проверки наличия данных в канале
+            recv (Callable[[int], bytes]): Функция приема данных из канала
+
+        Returns:
+            List[bytes]: Принятые блоки данных
+        """
+
+        chunks: List[bytes] = []
+        while len(chunks) < WRITEV_MAX_CHUNKS and recv_ready():
+            chunks.append(recv(RECV_BUFFER_SIZE))
+        return chunks
+
+    @staticmethod
+    def _write_chunks(output_file: BinaryIO, chunks: List[bytes]):
+        """
+        Запись принятых блоков данных в файл.
+        Небольшие объемы данных накапливаются в буфере файла, а крупные записываются
+        напрямую одним системным вызовом writev без копирования в буфер файла.
+
+        Args:
+            output_file (BinaryIO): Файл в который записываются данные
+            chunks (List[bytes]): Блоки данных, список изменяется в процессе записи
+        """
+
+        if not hasattr(os, 'writev') or sum(map(len, chunks)) < WRITEV_THRESHOLD:
+            for chunk in chunks:
+                output_file.write(chunk)
+            return
+
+        # Сначала сбрасываем ранее накопленные данные, чтобы сохранить порядок записи
+        output_file.flush()
+        fileno = output_file.fileno()
+        while chunks:
+            written = os.writev(fileno, chunks)
+            while chunks and written >= len(chunks[0]):
+                written -= len(chunks.pop(0))
+            if chunks:
+                # Срез memoryview не копирует недописанный остаток блока
+                chunks[0] = memoryview(chunks[0])[written:]  # type: ignore
+
+    @staticmethod
+    def _drop_page_cache(fileno: int, dropped_offset: int) -> int:
+        """
+        Освобождение страничного кэша для уже записанной части файла.
+        Записанные данные в процессе повторно не читаются, поэтому не должны вытеснять из памяти полезный кэш.
+        Последнее окно записанных данных не освобождается, чтобы его страницы успели записаться на диск,
+        так как POSIX_FADV_DONTNEED не затрагивает "грязные" страницы.
+
+        Args:
+            fileno (int): Дескриптор файла
+            dropped_offset (int): Смещение до которого кэш уже был освобожден
+
+        Returns:
+            int: Новое смещение до которого освобожден кэш
+        """
+
+        if not hasattr(os, 'posix_fadvise'):
+            return dropped_offset
+        try:
+            drop_until = os.lseek(fileno, 0, os.SEEK_CUR) - PAGE_CACHE_DROP_WINDOW
+            if drop_until - dropped_offset < PAGE_CACHE_DROP_WINDOW:
+                return dropped_offset
+            os.posix_fadvise(fileno, dropped_offset, drop_until - dropped_offset, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            # Например, если вывод направлен в канал, а не в обычный файл
+            return dropped_offset
+        return drop_until
+
     def stop(self):
         """
         Остановка сниффера.
@@ -96,6 +267,11 @@ class Dumper(Thread, ABC):
         if self.is_alive():
             self._logger.info('Stoping ...')
             self._need_stop = True
+            # Пробуждаем поток ожидающий событий от SSH канала,
+            # если поток еще не создал пару сокетов, то он увидит флаг остановки до начала ожидания
+            if self._wakeup_writer is not None:
+                with suppress(OSError):
+                    self._wakeup_writer.send(b'\0')
             self.join()
 
 
@@ -112,18 +288,8 @@ class LogDump(Dumper):
                  username: str, password: str, output_file: str, dumped_file: str):
         super().__init__(name, address, port, username, password, output_file)
         self._dumped_file = dumped_file
-
-    def __repr__(self) -> str:
-        repr_value = f'{self.__class__.__name__}(name={repr(self.name)}'
-        for attr_name in ('address', 'port', 'username', 'password'):
-            attr_value = repr(self._connection_parameters[attr_name])
-            repr_value += f', {attr_name}={attr_value}'
-        repr_value += f', output_file={repr(self._output_file)}, dumped_file={repr(self._dumped_file)})'
-        return repr_value
-
-    @property
-    def executed_command(self) -> str:
-        return f'tail --follow=name --retry --lines=1 {self._dumped_file}'
+        self._executed_command = f'tail --follow=name --retry --lines=1 {dumped_file}'
+        self._repr = self._build_repr(dumped_file=dumped_file)
 
 
 class PCAPDump(Dumper):
@@ -139,15 +305,5 @@ class PCAPDump(Dumper):
                  username: str, password: str, output_file: str, dumped_interface: str = 'any'):
         super().__init__(name, address, port, username, password, output_file)
         self._dumped_interface = dumped_interface
-
-    def __repr__(self) -> str:
-        repr_value = f'{self.__class__.__name__}(name={repr(self.name)}'
-        for attr_name in ('address', 'port', 'username', 'password'):
-            attr_value = repr(self._connection_parameters[attr_name])
-            repr_value += f', {attr_name}={attr_value}'
-        repr_value += f', output_file={repr(self._output_file)}, dumped_interface={repr(self._dumped_interface)})'
-        return repr_value
-
-    @property
-    def executed_command(self) -> str:
-        return f'tcpdump -i {self._dumped_interface} -U -w - -f not tcp port 22'
+        self._executed_command = f'tcpdump -i {dumped_interface} -U -w - -f not tcp port 22'
+        self._repr = self._build_repr(dumped_interface=dumped_interface)
@@ -1,10 +1,27 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from app.api.hosts import hosts_api
+from app.db.hosts import init_db
 
 APP_DESCRIPTION = """
 API сервиса для дебага других микросервисов.
 """
 
-app = FastAPI(description=APP_DESCRIPTION)
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    Обработчик жизненного цикла приложения, при запуске создает схему базы данных.
+
+    Args:
+        _app (FastAPI): Приложение
+    """
+
+    init_db()
+    yield
+
+
+app = FastAPI(description=APP_DESCRIPTION, lifespan=lifespan)
 app.include_router(hosts_api)
@@ -1,5 +1,5 @@
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Host(BaseModel):
@@ -13,7 +13,4 @@ class Host(BaseModel):
     username: str
     password: str
 
-    class Config:
-        """Конфигурация модели."""
-
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
@@ -1,5 +1,5 @@
 from typing import Optional, Literal
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Task(BaseModel):
@@ -10,7 +10,4 @@ class Task(BaseModel):
     task_type: Literal['log_dump', 'pcap_dump']
     is_alive: bool
 
-    class Config:
-        """Конфигурация модели."""
-
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
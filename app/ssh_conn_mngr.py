@@ -1,12 +1,18 @@
+import atexit
 import logging
-import string
+import secrets
 from threading import Lock
 from typing import Union, Tuple, Generator, Dict
-from random import choices
 from contextlib import contextmanager
 
 import paramiko
 
+# Подключение выполняется под блокировкой менеджера, поэтому общее время ожидания недоступного хоста ограничено
+SSH_CONNECT_TIMEOUT = 10
+# Этапы подключения paramiko, каждый со своим таймаутом: TCP подключение, получение баннера,
+# обмен ключами и аутентификация
+SSH_CONNECT_STAGES = 4
+
 
 class SingletonMeta(type):
     """
@@ -17,6 +23,9 @@ class SingletonMeta(type):
     _lock: Lock = Lock()
 
     def __call__(cls, *args, **kwargs):
+        # Блокировка нужна только пока экземпляр еще не создан
+        if cls._instance is not None:
+            return cls._instance
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super().__call__(*args, **kwargs)
@@ -38,8 +47,13 @@ class SSHConnectionManager(metaclass=SingletonMeta):
         self._logger = logging.getLogger(self.name)
         self._logger.info('Start init new SSHConnectionManager')
         self._lock = Lock()
-        self._connections: Dict[Tuple[str, int], paramiko.SSHClient] = {}
-        self._leases: Dict[str, Tuple[str, int]] = {}
+        # Подключения различаются адресом, портом и именем пользователя,
+        # чтобы разные пользователи одного хоста не получали чужую аутентифицированную сессию
+        self._connections: Dict[Tuple[str, int, str], paramiko.SSHClient] = {}
+        self._leases: Dict[str, Tuple[str, int, str]] = {}
+        self._refcounts: Dict[Tuple[str, int, str], int] = {}
+        # Закрываем подключения при штатном завершении интерпретатора, а не в финализаторе объекта
+        atexit.register(self.destroy_all_connections)
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(name={repr(self.name)})'
@@ -52,16 +66,16 @@ class SSHConnectionManager(metaclass=SingletonMeta):
             str: Идентификатор аренды
         """
 
-        lease_id = ''.join(choices(string.ascii_uppercase + string.digits, k=8))
-        if lease_id in self._leases:
-            return self.get_random_lease_id()
+        lease_id = secrets.token_hex(4).upper()
+        while lease_id in self._leases:
+            lease_id = secrets.token_hex(4).upper()
         return lease_id
 
-    def get_connection(self, address: str, port: Union[str, int],
-                       username: str, password: str) -> Tuple[str, paramiko.SSHClient]:
+    def get_connection(self, address: str, port: Union[str, int], username: str, password: str,
+                       timeout: float = SSH_CONNECT_TIMEOUT) -> Tuple[str, paramiko.SSHClient]:
         """
         Создание нового SSH подключения,
-        если подключение по указанному адресу и порту уже было ранее создано,
+        если подключение по указанному адресу и порту для этого же пользователя уже было ранее создано,
         то будет использоваться существующее подключение.
 
         Args:
@@ -69,6 +83,8 @@ class SSHConnectionManager(metaclass=SingletonMeta):
             port (Union[str, int]): SSH порт удаленной стороны
             username (str): Имя пользователя
             password (str): Пароль пользователя
+            timeout (float, optional): Общее время ожидания нового подключения в секундах.
+                                       Defaults to SSH_CONNECT_TIMEOUT.
 
         Returns:
             Tuple[str, paramiko.SSHClient]: Кортеж из идентификатора аренды подключения
@@ -76,29 +92,31 @@ class SSHConnectionManager(metaclass=SingletonMeta):
         """
 
         self._logger.info(f'Request new SSH connection: {username}:{password}@{address}:{port}')
+        key = (address, int(port), username)
         with self._lock:
-            self._logger.debug(f'Open connections: {self._connections}')
-            self._logger.debug(f'Active leases: {self._leases}')
+            self._logger.debug('Open connections: %r', self._connections)
+            self._logger.debug('Active leases: %r', self._leases)
             lease_id = self.get_random_lease_id()
-            if (address, int(port)) in self._connections:
-                # Get existing connection
-                conn = self._connections[(address, int(port))]
-            else:
+            conn = self._connections.get(key)
+            if conn is None:
                 # Create new connection
-                conn = self._create_ssh_connection(address, port, username, password)
-                self._connections[(address, int(port))] = conn
-            self._logger.info(f'Create new lease connection: {lease_id}, '
-                              f'connection: {(address, int(port))}')
-            self._leases[lease_id] = (address, int(port))
+                conn = self._create_ssh_connection(address, key[1], username, password, timeout)
+                self._connections[key] = conn
+            self._logger.info(f'Create new lease connection: {lease_id}, connection: {key}')
+            self._leases[lease_id] = key
+            self._refcounts[key] = self._refcounts.get(key, 0) + 1
 
         return lease_id, conn
 
-    def _create_ssh_connection(self, address: str, port: Union[str, int],
-                               username: str, password: str) -> paramiko.SSHClient:
+    def _create_ssh_connection(self, address: str, port: Union[str, int], username: str, password: str,
+                               timeout: float) -> paramiko.SSHClient:
         self._logger.info(f'Create new SSH connection: {username}:{password}@{address}:{port}')
         ssh_client = paramiko.SSHClient()
         ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname=address, username=username, password=password, port=int(port))
+        # Таймауты paramiko действуют на каждый этап отдельно, поэтому общее время делится между этапами
+        stage_timeout = timeout / SSH_CONNECT_STAGES
+        ssh_client.connect(hostname=address, username=username, password=password, port=int(port),
+                           timeout=stage_timeout, banner_timeout=stage_timeout, auth_timeout=stage_timeout)
         return ssh_client
 
     def release_connection(self, lease_id: str):
@@ -116,22 +134,22 @@ class SSHConnectionManager(metaclass=SingletonMeta):
         """
 
         self._logger.info(f'Release connection with lease_id: {lease_id}')
-        self._logger.debug(f'Open connections: {self._connections}')
-        self._logger.debug(f'Active leases: {self._leases}')
+        self._logger.debug('Open connections: %r', self._connections)
+        self._logger.debug('Active leases: %r', self._leases)
 
-        if lease_id not in self._leases:
-            raise LookupError(f'Failed to find the lease ID {lease_id} in lease list')
+        with self._lock:
+            if lease_id not in self._leases:
+                raise LookupError(f'Failed to find the lease ID {lease_id} in lease list')
 
-        released_connection = self._leases.pop(lease_id)
+            released_connection = self._leases.pop(lease_id)
 
-        for leased_connection in self._leases.values():
-            if leased_connection == released_connection:
-                break
-        else:
-            self._destroy_connection(*released_connection)
+            self._refcounts[released_connection] -= 1
+            if self._refcounts[released_connection] == 0:
+                del self._refcounts[released_connection]
+                self._destroy_connection(*released_connection)
 
-    def _destroy_connection(self, address: str, port: Union[str, int]):
-        destroyed_connection = (address, int(port))
+    def _destroy_connection(self, address: str, port: Union[str, int], username: str):
+        destroyed_connection = (address, int(port), username)
         self._logger.info(f'Close connection: {destroyed_connection}')
 
         if destroyed_connection not in self._connections:
@@ -142,15 +160,18 @@ class SSHConnectionManager(metaclass=SingletonMeta):
     def destroy_all_connections(self):
         """Закрытие всех SSH подключений и аннулирование всех аренд."""
 
+        # Подключения уже закрыты, поэтому обработчик при завершении интерпретатора больше не нужен
+        atexit.unregister(self.destroy_all_connections)
         self._logger.info('Destroy all connections')
-        self._logger.debug(f'Open connections: {self._connections}')
-        self._logger.debug(f'Active leases: {self._leases}')
+        self._logger.debug('Open connections: %r', self._connections)
+        self._logger.debug('Active leases: %r', self._leases)
 
         for conn in self._connections.values():
             conn.close()
 
         self._connections.clear()
         self._leases.clear()
+        self._refcounts.clear()
 
     @contextmanager
     def connection(self, address: str, port: Union[str, int],
@@ -172,6 +193,3 @@ class SSHConnectionManager(metaclass=SingletonMeta):
         lease_id, conn = self.get_connection(address, port, username, password)
         yield conn
         self.release_connection(lease_id)
-
-    def __del__(self):
-        self.destroy_all_connections()
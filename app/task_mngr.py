@@ -1,41 +1,119 @@
 import os
 import logging
-import string
 import multiprocessing
 import threading
-from dataclasses import dataclass, field
-from logging.handlers import QueueHandler
-from typing import Union, List, Dict, Any
-from queue import Empty
-from random import choices
+import time
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass, field, replace
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.connection import Connection, wait
+from typing import Union, Optional, List, Dict, Tuple, Any, Callable, Deque
 
 from .dumpers import Dumper, PCAPDump, LogDump
-from .ssh_conn_mngr import SSHConnectionManager
+from .ssh_conn_mngr import SSHConnectionManager, SSH_CONNECT_TIMEOUT
 from .models.task import Task
 
 
-@dataclass
+@dataclass(frozen=True)
 class TaskManagerCommand:
     """
     Класс вызова метода выполняемого в дочернем процессе.
     """
 
     name: str
-    args: tuple = field(default_factory=list)  # type: ignore
+    args: tuple = field(default_factory=tuple)
     kwargs: dict = field(default_factory=dict)
+    # Порядковый номер вызова, возвращается в результате для сопоставления ответа с запросом
+    seq: int = 0
+    # Момент времени (time.time()), после которого ответ на вызов уже не ожидается, None - без ограничения
+    deadline: Optional[float] = None
 
+    def __reduce__(self):
+        # Сериализуется как вызов конструктора, без словаря атрибутов экземпляра
+        return self.__class__, (self.name, self.args, self.kwargs, self.seq, self.deadline)
 
-@dataclass
+
+@dataclass(frozen=True)
 class TaskManagerResult:
     """
     Класс результата выполненной команды.
     """
 
     data: Any
+    seq: int = 0
+
+    def __reduce__(self):
+        return self.__class__, (self.data, self.seq)
 
 
 context = multiprocessing.get_context('spawn')
 
+# Потоки субпроцесса (дамперы и транспорты SSH) только перекладывают данные и не используют глубокую рекурсию,
+# поэтому стандартный стек (обычно 8 MiB) для них избыточен
+THREAD_STACK_SIZE = 512 * 1024
+# Лог записи субпроцесса передаются пачками: при заполнении буфера, по интервалу или сразу при ошибке
+LOG_BUFFER_CAPACITY = 64
+LOG_FLUSH_INTERVAL = 0.1
+# Часть таймаута вызова, оставляемая на передачу ответа, время SSH подключения ограничено оставшейся частью
+RPC_ANSWER_MARGIN = 0.5
+
+
+class PipeLogHandler(QueueHandler):
+    """
+    Обработчик лог записей, передающий подготовленные записи в родительский процесс через канал Pipe.
+    Вместо всей записи передается кортеж (имя логгера, уровень, время создания, имя потока,
+    отформатированное сообщение), запись форматируется в момент логирования.
+    Кортежи передаются списками: при заполнении буфера, сразу при записи уровня ERROR и выше
+    и не позднее чем через LOG_FLUSH_INTERVAL после появления первой записи в буфере.
+    Поток отправки буфера просыпается только когда в буфере есть записи.
+    """
+
+    def __init__(self, connection: Connection, capacity: int = LOG_BUFFER_CAPACITY,
+                 flush_interval: float = LOG_FLUSH_INTERVAL):
+        super().__init__(connection)  # type: ignore
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._buffer: List[Tuple[str, int, float, Optional[str], str]] = []
+        self._has_records = threading.Event()
+        self._closing = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_pending, name='log_flush', daemon=True)
+        self._flush_thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> Tuple[str, int, float, Optional[str], str]:
+        # Форматирование включает в сообщение аргументы и текст исключения
+        return record.name, record.levelno, record.created, record.threadName, self.format(record)
+
+    def enqueue(self, record):
+        # Вызывается из emit под блокировкой обработчика
+        self._buffer.append(record)
+        if len(self._buffer) >= self.capacity or record[1] >= logging.ERROR:
+            self.flush()
+        else:
+            self._has_records.set()
+
+    def flush(self):
+        with self.lock:  # type: ignore
+            records, self._buffer = self._buffer, []
+            self._has_records.clear()
+            if records:
+                self.queue.send(records)  # type: ignore
+
+    def _flush_pending(self):
+        while not self._closing.is_set():
+            self._has_records.wait()
+            # Даем накопиться записям, но не дольше интервала
+            self._closing.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self._closing.set()
+        self._has_records.set()
+        self._flush_thread.join()
+        # Отправка оставшихся в буфере записей
+        self.flush()
+        super().close()
+
 
 class ProcessTaskManager(context.Process):  # type: ignore
     """
@@ -46,78 +124,121 @@ class ProcessTaskManager(context.Process):  # type: ignore
         - контроль созданных задач.
     """
 
-    def __init__(self, name: str, log_queue: context.Queue,  # type: ignore
-                 cmd_queue: context.Queue, res_queue: context.Queue):  # type: ignore
+    def __init__(self, name: str, log_connection: Connection, rpc_connection: Connection,
+                 log_level: int = logging.DEBUG):
         super().__init__(daemon=True)
         self.name = name
-        self.need_stop = context.Event()
         self._logger = logging.getLogger(self.name)
-        self._log_queue = log_queue
-        self._cmd_queue = cmd_queue
-        self._res_queue = res_queue
+        self._log_connection = log_connection
+        self._log_level = log_level
+        self._rpc_connection = rpc_connection
         self._tasks: Dict[str, Dumper] = {}
+        self._last_task_number = 0
 
     def run(self):
         """Главный цикл субпроцесса."""
 
         logger_name = f'proc_{os.getpid()}'
-        logger = logging.getLogger(logger_name)
-        logger.addHandler(QueueHandler(self._log_queue))
-        logger.setLevel(logging.DEBUG)
-
-        SSHConnectionManager(f'{logger_name}.ssh_mngr')
-
-        while not self.need_stop.is_set():
-            try:
-                cmd = self._cmd_queue.get(timeout=1)
-            except Empty:
-                continue
-
-            logger.info(f'Trying to execute command "{cmd.name}" with {cmd.args = } {cmd.kwargs = }')
+        log_handler = PipeLogHandler(self._log_connection)
+        self._logger = logging.getLogger(logger_name)
+        self._logger.addHandler(log_handler)
+        # Записи ниже уровня фронтовой части отбрасываются еще до передачи в родительский процесс
+        self._logger.setLevel(self._log_level)
+        # Снифферы пишут в общий логгер модуля app.dumpers
+        app_logger = logging.getLogger('app')
+        app_logger.addHandler(log_handler)
+        app_logger.setLevel(self._log_level)
+        threading.stack_size(THREAD_STACK_SIZE)
+
+        ssh_manager = SSHConnectionManager(f'{logger_name}.ssh_mngr')
+
+        need_stop = False
+        while not need_stop:
             try:
-                method = getattr(self, f'_{cmd.name}', None)
-                if method is None:
-                    returned_value = Exception(f'Unknown command: "{cmd.name}"')
-                else:
-                    returned_value = method(cmd)
-            # pylint: disable-next=broad-exception-caught
-            except Exception as error:
-                returned_value = error
-            self._res_queue.put(TaskManagerResult(returned_value))
+                commands = [self._rpc_connection.recv()]
+                # Забираем все накопившиеся команды за одно пробуждение
+                while self._rpc_connection.poll():
+                    commands.append(self._rpc_connection.recv())
+            except EOFError:
+                # Фронтовая часть закрыла канал, дальнейших команд не будет
+                commands = [None]
+
+            for cmd in commands:
+                if cmd is None:
+                    # Получен сигнал остановки от фронтовой части
+                    need_stop = True
+                    break
+
+                self._rpc_connection.send(TaskManagerResult(self._execute_command(cmd), cmd.seq))
 
         for task_id, task in self._tasks.items():
-            logger.info(f'Stopping task "{task_id}"')
+            self._logger.info(f'Stopping task "{task_id}"')
             task.stop()
+        # Подключения закрываются явно, пока лог записи еще передаются в родительский процесс,
+        # при этом обработчик atexit менеджера снимается и повторно не вызывается
+        ssh_manager.destroy_all_connections()
+        # При закрытии в родительский процесс отправляются оставшиеся в буфере записи
+        log_handler.close()
+
+    def _execute_command(self, cmd: TaskManagerCommand) -> Any:
+        self._logger.info(f'Trying to execute command "{cmd.name}" with {cmd.args = } {cmd.kwargs = }')
+        if cmd.deadline is not None and time.time() >= cmd.deadline:
+            # Вызывающий уже не ожидает ответ, поэтому команда не выполняется
+            return TimeoutError(f'Command "{cmd.name}" has expired before execution')
+        try:
+            handler = self._command_handlers.get(cmd.name)
+            if handler is None:
+                returned_value = Exception(f'Unknown command: "{cmd.name}"')
+            else:
+                returned_value = handler(self, cmd)
+        # pylint: disable-next=broad-exception-caught
+        except Exception as error:
+            returned_value = error
+        return returned_value
 
-    def _get_random_task_id(self):
-        identifier = ''.join(choices(string.ascii_uppercase + string.digits, k=8))
-        if identifier in self._tasks:
-            return self._get_random_task_id()
-        return identifier
+    @staticmethod
+    def _task_info(task_id: str, dumper: Dumper) -> Task:
+        # Данные задачи формирует сам менеджер, поэтому повторная валидация модели не требуется
+        return Task.model_construct(task_id=task_id, name=dumper.name,
+                                    task_type=dumper.task_type, is_alive=dumper.is_alive())
+
+    @staticmethod
+    def _connect_timeout(cmd: TaskManagerCommand) -> float:
+        # Подключение должно завершиться до истечения таймаута вызова, иначе задача запустится без ведома вызывающего
+        if cmd.deadline is None:
+            return SSH_CONNECT_TIMEOUT
+        timeout = cmd.deadline - time.time() - RPC_ANSWER_MARGIN
+        if timeout <= 0:
+            raise TimeoutError(f'No time left to connect within the deadline of command "{cmd.name}"')
+        return min(timeout, SSH_CONNECT_TIMEOUT)
+
+    def _get_new_task_id(self) -> str:
+        # Счетчик гарантирует уникальность идентификаторов без проверки по списку задач
+        self._last_task_number += 1
+        return f'{self._last_task_number:08X}'
 
     def _start_pcap_dump(self, cmd: TaskManagerCommand) -> Task:
-        task_id = self._get_random_task_id()
+        task_id = self._get_new_task_id()
         dumper = PCAPDump(f'proc_{os.getpid()}.pcap_{task_id}', *cmd.args, **cmd.kwargs)
+        dumper.connect(timeout=self._connect_timeout(cmd))
         dumper.start()
         self._tasks[task_id] = dumper
-        return Task(task_id=task_id, name=dumper.name,
-                    task_type=dumper.task_type, is_alive=dumper.is_alive())
+        return self._task_info(task_id, dumper)
 
     def _start_log_dump(self, cmd: TaskManagerCommand) -> Task:
-        task_id = self._get_random_task_id()
+        task_id = self._get_new_task_id()
         dumper = LogDump(f'proc_{os.getpid()}.log_{task_id}', *cmd.args, **cmd.kwargs)
+        dumper.connect(timeout=self._connect_timeout(cmd))
         dumper.start()
         self._tasks[task_id] = dumper
-        return Task(task_id=task_id, name=dumper.name,
-                    task_type=dumper.task_type, is_alive=dumper.is_alive())
+        return self._task_info(task_id, dumper)
 
     def _get_task_info(self, cmd: TaskManagerCommand) -> Union[Task, Exception]:
         task_id = cmd.args[0]
         dumper = self._tasks.get(task_id, None)
         if dumper is None:
             return LookupError(f'Task with id="{task_id}" not found in task list.')
-        return Task(task_id=task_id, name=dumper.name,
-                    task_type=dumper.task_type, is_alive=dumper.is_alive())
+        return self._task_info(task_id, dumper)
 
     def _stop_task(self, cmd: TaskManagerCommand) -> Union[Task, Exception]:
         task_id = cmd.args[0]
@@ -125,33 +246,61 @@ class ProcessTaskManager(context.Process):  # type: ignore
         if dumper is None:
             return LookupError(f'Task with id="{task_id}" not found in task list.')
         dumper.stop()
-        return Task(task_id=task_id, name=dumper.name,
-                    task_type=dumper.task_type, is_alive=dumper.is_alive())
+        return self._task_info(task_id, dumper)
 
     def _get_all_tasks(self, _cmd: TaskManagerCommand) -> List[Task]:
-        returned_value = []
-        for task_id, task in self._tasks.items():
-            returned_value.append(Task(task_id=task_id, name=task.name,
-                                       task_type=task.task_type, is_alive=task.is_alive()))
-        return returned_value
+        return [self._task_info(task_id, task) for task_id, task in self._tasks.items()]
 
+    def _batch(self, cmd: TaskManagerCommand) -> List[Any]:
+        # Команды пакета ограничены временем ожидания ответа на весь пакет
+        return [self._execute_command(replace(sub_cmd, deadline=cmd.deadline)) for sub_cmd in cmd.args[0]]
 
-class LogProxyThread(threading.Thread):
-    """Прокси для лог записей, получает записи из очереди и передает их логгеру."""
+    # Обработчики команд определяются один раз при создании класса,
+    # вызвать через RPC можно только перечисленные здесь методы
+    _command_handlers: Dict[str, Callable[['ProcessTaskManager', TaskManagerCommand], Any]] = {
+        'start_pcap_dump': _start_pcap_dump,
+        'start_log_dump': _start_log_dump,
+        'get_task_info': _get_task_info,
+        'stop_task': _stop_task,
+        'get_all_tasks': _get_all_tasks,
+        'batch': _batch,
+    }
 
-    def __init__(self, name: str, log_queue: context.Queue, logger: logging.Logger):  # type: ignore
-        super().__init__(name=name, daemon=True)
-        self.need_stop = threading.Event()
-        self._log_queue = log_queue
-        self._logger = logger
 
-    def run(self):
-        while not self.need_stop.is_set():
-            try:
-                message = self._log_queue.get(timeout=1)
-            except Empty:
-                continue
-            self._logger.handle(message)
+class PipeLogListener(QueueListener):
+    """
+    Слушатель лог записей, получает записи из канала Pipe и передает их логгеру.
+    Сигнал остановки отправляется через пишущий конец того же канала.
+    """
+
+    def __init__(self, log_reader: Connection, log_writer: Connection, logger: logging.Logger):
+        super().__init__(log_reader)  # type: ignore
+        self._log_writer = log_writer
+        self._logger = logger
+        self._records: Deque[logging.LogRecord] = deque()
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        # Субпроцесс передает записи списками, они выдаются по одной
+        if not self._records:
+            item = self.queue.recv()  # type: ignore
+            if item is self._sentinel:  # type: ignore
+                return item
+            # Время создания и поток берутся из субпроцесса, msecs вычисляется так же, как в LogRecord
+            self._records.extend(logging.makeLogRecord({'name': name, 'levelno': level,
+                                                        'levelname': logging.getLevelName(level),
+                                                        'created': created,
+                                                        'msecs': int((created - int(created)) * 1000) + 0.0,
+                                                        'threadName': thread_name, 'msg': msg})
+                                 for name, level, created, thread_name, msg in item)
+        return self._records.popleft()
+
+    def enqueue_sentinel(self):
+        self._log_writer.send(self._sentinel)  # type: ignore
+
+    def handle(self, record: logging.LogRecord):
+        # Logger.handle не проверяет уровень записи, а уровень логгера мог измениться после запуска субпроцесса
+        if self._logger.isEnabledFor(record.levelno):
+            self._logger.handle(record)
 
 
 class TaskManager:
@@ -170,11 +319,14 @@ class TaskManager:
         self.timeout = timeout
         self._logger = logging.getLogger(self.name)
         self._process = None
-        self._log_thread = None
-        self._need_stop = None
-        self._log_queue = None
-        self._cmd_queue = None
-        self._res_queue = None
+        self._log_listener = None
+        self._log_reader = None
+        self._log_writer = None
+        self._rpc_connection = None
+        self._rpc_lock = threading.Lock()
+        self._last_rpc_seq = 0
+        # Команды вызовов, завершившихся по таймауту, по их порядковым номерам
+        self._timed_out_calls: Dict[int, str] = {}
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(name={repr(self.name)}, timeout={repr(self.timeout)})'
@@ -183,31 +335,74 @@ class TaskManager:
         """Запуск "бековой" субпроцессной части."""
 
         if self._process is None:
-            self._log_queue = context.Queue()
-            self._cmd_queue = context.Queue()
-            self._res_queue = context.Queue()
-            self._process = ProcessTaskManager(name=self.name, log_queue=self._log_queue,
-                                               cmd_queue=self._cmd_queue, res_queue=self._res_queue)
+            self._log_reader, self._log_writer = context.Pipe(duplex=False)
+            self._rpc_connection, process_rpc_connection = context.Pipe(duplex=True)
+            self._process = ProcessTaskManager(name=self.name, log_connection=self._log_writer,
+                                               rpc_connection=process_rpc_connection,
+                                               log_level=self._logger.getEffectiveLevel())
             self._process.start()
-            self._log_thread = LogProxyThread(name=self.name, log_queue=self._log_queue, logger=self._logger)
-            self._log_thread.start()
+            # Конец канала субпроцесса нужен только ему самому
+            process_rpc_connection.close()
+            self._log_listener = PipeLogListener(self._log_reader, self._log_writer, self._logger)
+            self._log_listener.start()
 
     def _send_rpc_command(self, rpc_command: TaskManagerCommand) -> TaskManagerResult:
         if self._process is None:
             raise RuntimeError('TaskManager not started!')
 
-        self._cmd_queue.put(rpc_command)
-
-        try:
-            result = self._res_queue.get(timeout=self.timeout)
-        except Empty as error:
-            raise TimeoutError(f'No answer was received within {self.timeout}s') from error
+        # Канал общий, поэтому запрос и ответ одного вызова не должны перемежаться с другими вызовами
+        with self._rpc_lock:
+            self._last_rpc_seq += 1
+            rpc_command = replace(rpc_command, seq=self._last_rpc_seq, deadline=time.time() + self.timeout)
+            deadline = time.monotonic() + self.timeout
+            try:
+                self._rpc_connection.send(rpc_command)
+                while True:
+                    # Ожидаем ответ или завершение субпроцесса, чтобы не ждать весь таймаут, если ответа не будет
+                    ready = wait([self._rpc_connection, self._process.sentinel],
+                                 timeout=max(deadline - time.monotonic(), 0))
+                    if not ready:
+                        self._timed_out_calls[rpc_command.seq] = rpc_command.name
+                        raise TimeoutError(f'No answer was received within {self.timeout}s')
+                    if self._rpc_connection not in ready:
+                        raise EOFError
+                    result = self._rpc_connection.recv()
+                    if result.seq == rpc_command.seq:
+                        break
+                    stop_command = self._handle_stale_result(result)
+                    if stop_command is not None:
+                        # Ответ на остановку никто не ожидает, он будет отброшен как запоздавший
+                        self._timed_out_calls[stop_command.seq] = stop_command.name
+                        self._rpc_connection.send(stop_command)
+            except (EOFError, BrokenPipeError) as error:
+                raise RuntimeError(f'TaskManager subprocess has terminated with exit code {self._process.exitcode}') \
+                    from error
 
         if isinstance(result.data, Exception):
             raise result.data
 
         return result
 
+    def _handle_stale_result(self, result: TaskManagerResult) -> Optional[TaskManagerCommand]:
+        """
+        Обработка запоздавшего ответа на вызов, который ранее завершился по таймауту.
+        Задача, запущенная таким вызовом, неизвестна вызывающему, поэтому она должна быть остановлена.
+
+        Args:
+            result (TaskManagerResult): Запоздавший ответ
+
+        Returns:
+            Optional[TaskManagerCommand]: Команда остановки запущенной задачи, если такая задача есть
+        """
+
+        command_name = self._timed_out_calls.pop(result.seq, None)
+        if command_name in ('start_pcap_dump', 'start_log_dump') and isinstance(result.data, Task):
+            self._logger.warning(f'Stopping task "{result.data.task_id}" started by timed out RPC call #{result.seq}')
+            self._last_rpc_seq += 1
+            return TaskManagerCommand(name='stop_task', args=(result.data.task_id,), seq=self._last_rpc_seq)
+        self._logger.warning(f'Discarding stale answer to RPC call #{result.seq}')
+        return None
+
     def start_pcap_dump(self, address: str, port: Union[str, int],
                         username: str, password: str, output_file: str) -> Task:
         """
@@ -293,18 +488,43 @@ class TaskManager:
         result = self._send_rpc_command(command)
         return result.data
 
+    def batch(self, commands: List[TaskManagerCommand]) -> List[Any]:
+        """
+        Выполнить несколько команд за один обмен с субпроцессом.
+        Ошибка выполнения одной из команд не прерывает выполнение остальных,
+        вместо результата такой команды возвращается объект исключения.
+
+        Args:
+            commands (List[TaskManagerCommand]): Список выполняемых команд
+
+        Returns:
+            List[Any]: Список результатов выполнения команд в порядке их передачи
+        """
+
+        command = TaskManagerCommand(name='batch', args=(commands,))
+        result = self._send_rpc_command(command)
+        return result.data
+
     def stop(self):
         """Остановка субпроцесса."""
 
-        self._process.need_stop.set()
-        if self._process is not None:
-            self._process.join()
-        self._log_thread.need_stop.set()
-        if self._log_thread is not None:
-            self._log_thread.join()
+        if self._process is None:
+            return
+
+        with suppress(BrokenPipeError):
+            # Субпроцесс мог уже завершиться аварийно
+            self._rpc_connection.send(None)
+        self._process.join()
+        # Субпроцесс завершен и больше не пишет в канал логов,
+        # поэтому сигнал остановки не может перемешаться с его записями
+        self._log_listener.stop()
+
+        self._log_reader.close()
+        self._log_writer.close()
+        self._rpc_connection.close()
 
         self._process = None
-        self._log_thread = None
-        self._log_queue = None
-        self._cmd_queue = None
-        self._res_queue = None
+        self._log_listener = None
+        self._log_reader = None
+        self._log_writer = None
+        self._rpc_connection = None
@@ -1,37 +1,63 @@
+import os
+import re
+import mmap
+import time
+import shutil
+import hashlib
 import sqlite3
+import subprocess
+from typing import Callable
 
 import pytest
 import docker
 from fastapi.testclient import TestClient  # pylint: disable=wrong-import-order
+from scapy.all import PcapReader, ICMP  # pylint: disable=no-name-in-module,wrong-import-order
+from scapy.error import Scapy_Exception  # pylint: disable=wrong-import-order
 
 from app.main import app
+from app.api.hosts import all_hosts_cache
+
+TEST_SERVER_DOCKERFILE = 'docker/Dockerfile'
+DOCKERFILE_DIGEST_LABEL = 'services_debugger.dockerfile_sha256'
+# tcpdump отбирает пакеты BPF фильтром без разбора каждого пакета в Python, scapy используется если его нет
+TCPDUMP = shutil.which('tcpdump')
+PING_LINE_PATTERN = re.compile(rb'^64 bytes from 127\.0\.0\.1: seq=\d+ ttl=64 time=\d+\.\d{3} ms$', re.MULTILINE)
 
 
 @pytest.fixture(scope='session')
 def test_client() -> TestClient:
     """
     Фикстура для создания тестового клиента API.
+    Клиент используется как контекстный менеджер, чтобы при запуске приложения была создана схема базы данных.
 
-    Returns:
-        TestClient: Тестовый клиент API
+    Yields:
+        Iterator[TestClient]: Тестовый клиент API
     """
 
-    client = TestClient(app)
-    return client
+    with TestClient(app) as client:
+        yield client
 
 
-@pytest.fixture()
-def db_connection() -> sqlite3.Connection:
+@pytest.fixture(scope='session')
+def db_connection(test_client: TestClient) -> sqlite3.Connection:  # pylint: disable=unused-argument
     """
     Фикстура для создания подключения к базе данных.
+    Подключение создается один раз на всю сессию тестов, изоляцию тестов обеспечивает drop_all_data_in_db.
     В SETUP происходит подключение к базе, в тест передается объект для взаимодействия с базой,
     а в TEARDOWN происходит закрытие подключения.
+    Зависит от тестового клиента, так как схема базы данных создается при запуске приложения.
+
+    Args:
+        test_client (TestClient): Тестовый клиент API
 
     Yields:
         Iterator[sqlite3.Connection]: Объект для взаимодействия с базой
     """
 
     connection = sqlite3.connect('test.db')
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA temp_store=MEMORY')
 
     yield connection
 
@@ -54,6 +80,21 @@ def drop_all_data_in_db(db_connection: sqlite3.Connection):
     cursor.execute('DELETE FROM hosts')
 
     db_connection.commit()
+    # Изменения в обход API не сбрасывают кэш списка хостов
+    all_hosts_cache.invalidate()
+
+
+def dockerfile_digest() -> str:
+    """
+    Получение хэша Dockerfile тестового сервера.
+    Хэш сохраняется в метке образа, чтобы после изменения Dockerfile образ был пересобран.
+
+    Returns:
+        str: SHA-256 хэш содержимого Dockerfile
+    """
+
+    with open(TEST_SERVER_DOCKERFILE, 'rb') as dockerfile:
+        return hashlib.sha256(dockerfile.read()).hexdigest()
 
 
 @pytest.fixture(scope='session')
@@ -62,21 +103,155 @@ def test_ssh_server():
     Фикстура для запуска Docker контейнера выполняющего роль тестового сервера,
     к которому происходит подключение по SSH протоколу в тестах.
     В запускаемом контейнере будет запущен "ping" c выводом отчета в файл следующей командой:
-    "ping localhost > /tmp/ping.log"
+    "ping -i 0.2 localhost > /tmp/ping.log"
+    Если контейнер уже запущен (например, оставлен для повторных прогонов тестов), то используется он
+    и по окончанию тестов не останавливается.
+    Образ и запущенный контейнер, собранные из предыдущей версии Dockerfile, пересоздаются.
     """
 
+    digest = dockerfile_digest()
     client = docker.from_env()
+    for running_container in client.containers.list(filters={'name': 'test_ssh_server'}):
+        if running_container.image.labels.get(DOCKERFILE_DIGEST_LABEL) == digest:
+            yield
+            return
+        running_container.remove(force=True)
+
     try:
-        _ = client.images.get('test_ssh_server')
+        image = client.images.get('test_ssh_server')
     except docker.errors.ImageNotFound:
+        image = None
+    if image is None or image.labels.get(DOCKERFILE_DIGEST_LABEL) != digest:
         _ = client.images.build(path='docker',
                                 tag='test_ssh_server',
+                                labels={DOCKERFILE_DIGEST_LABEL: digest},
                                 network_mode='host')
     container = client.containers.run(image='test_ssh_server',
                                       ports={'10022/tcp': [10022, 10023]},
                                       cap_add=['NET_ADMIN', 'CAP_NET_RAW'],
+                                      name='test_ssh_server',
+                                      auto_remove=True,
                                       detach=True)
 
     yield
 
     container.stop()
+
+
+def wait_for(predicate: Callable[[], bool], timeout: float = 10, interval: float = 0.1):
+    """
+    Ожидание выполнения условия.
+
+    Args:
+        predicate (Callable[[], bool]): Проверяемое условие
+        timeout (float, optional): Максимальное время ожидания в секундах. Defaults to 10.
+        interval (float, optional): Интервал между проверками в секундах. Defaults to 0.1.
+    """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return
+        time.sleep(interval)
+
+
+def file_not_empty(filename: str) -> bool:
+    """
+    Проверка того, что файл существует и в него уже записаны данные.
+
+    Args:
+        filename (str): Путь к файлу
+
+    Returns:
+        bool: True, если файл существует и не пуст
+    """
+
+    return os.path.isfile(filename) and os.path.getsize(filename) > 0
+
+
+def count_ping_requests(filename: str, limit: int) -> int:
+    """
+    Подсчет ICMP echo-request пакетов в pcap файле.
+    Файл читается потоково, чтение прекращается как только найдено limit пакетов.
+    Если установлен tcpdump, пакеты отбираются им, иначе разбираются scapy.
+
+    Args:
+        filename (str): Путь к pcap файлу
+        limit (int): Количество пакетов, после которого подсчет прекращается
+
+    Returns:
+        int: Количество пакетов, не больше limit
+    """
+
+    if TCPDUMP is not None:
+        # На неполном последнем пакете дописываемого файла tcpdump завершается с ошибкой,
+        # но уже прочитанные пакеты выводит, поэтому код возврата не проверяется
+        result = subprocess.run([TCPDUMP, '-nn', '-r', filename, '-c', str(limit), 'icmp[icmptype] = icmp-echo'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+        return len(result.stdout.splitlines())
+
+    count = 0
+    with PcapReader(filename) as pcap:
+        for pkt in pcap:
+            if ICMP in pkt and pkt[ICMP].type == 8:
+                count += 1
+                if count >= limit:
+                    break
+    return count
+
+
+def captured_ping_requests(filename: str, limit: int) -> int:
+    """
+    Подсчет ICMP echo-request пакетов в pcap файле во время записи.
+
+    Args:
+        filename (str): Путь к pcap файлу
+        limit (int): Количество пакетов, после которого подсчет прекращается
+
+    Returns:
+        int: Количество пакетов, 0 если файл еще не создан или не читается
+    """
+
+    if not file_not_empty(filename):
+        return 0
+    try:
+        return count_ping_requests(filename, limit)
+    except (EOFError, Scapy_Exception):
+        # Последний пакет может быть записан не полностью
+        return 0
+
+
+def captured_log_lines(filename: str) -> int:
+    """
+    Подсчет полных строк в файле дампа логов во время записи.
+
+    Args:
+        filename (str): Путь к файлу дампа логов
+
+    Returns:
+        int: Количество строк, 0 если файл еще не создан
+    """
+
+    if not os.path.isfile(filename):
+        return 0
+    with open(filename, 'rb') as log_file:
+        return log_file.read().count(b'\n')
+
+
+def check_captured_log_file(filename: str):
+    """
+    Проверка файла дампа логов.
+
+    Args:
+        filename (str): Путь к файлу дампа логов
+    """
+
+    assert os.path.isfile(filename)
+    assert os.path.getsize(filename) > 0
+
+    with open(filename, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_data:
+        matched_lengths = [len(match[0]) + 1 for match in PING_LINE_PATTERN.finditer(log_data)]
+        # Совпавшие строки вместе с переводами строк покрывают весь файл, только если лишних строк нет,
+        # у последней строки перевод строки может отсутствовать
+        assert sum(matched_lengths) in (len(log_data), len(log_data) + 1), 'Unmatched lines found'
+    assert len(matched_lengths) >= 4
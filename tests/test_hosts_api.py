@@ -4,6 +4,33 @@ import pytest
 from fastapi.testclient import TestClient
 from httpx import Response
 
+from app.api.hosts import all_hosts_cache
+from app.db.hosts import _dirty_dict
+from app.models.host import Host
+
+# Запросы к таблице хостов формируются один раз, значения передаются параметрами
+HOST_COLUMNS = ('name', 'description', 'ssh_address', 'ssh_port', 'username', 'password')
+INSERT_HOST_REQ = f'INSERT INTO hosts ({", ".join(HOST_COLUMNS)}) VALUES ({", ".join("?" * len(HOST_COLUMNS))})'
+HOST_EXISTS_REQ = f'SELECT EXISTS(SELECT 1 FROM hosts WHERE {" AND ".join(f"{col}=?" for col in HOST_COLUMNS)})'
+
+# Тестовые значения хостов общие для всех тестов, тесты их не изменяют
+FIRST_HOST = {
+    'name': 'first_service',
+    'description': 'Core service (Node 1)',
+    'ssh_address': '127.0.0.1',
+    'ssh_port': 9022,
+    'username': 'test_user_1',
+    'password': 'test_password_1'
+}
+SECOND_HOST = {
+    'name': 'second_service',
+    'description': 'Core service (Node 2)',
+    'ssh_address': '127.0.0.2',
+    'ssh_port': 10022,
+    'username': 'test_user_1',
+    'password': 'test_password_2'
+}
+
 
 @pytest.fixture()
 def first_host() -> dict:
@@ -14,14 +41,22 @@ def first_host() -> dict:
         dict: Словарь с тестовыми значениями первого хоста
     """
 
-    return {
-        'name': 'first_service',
-        'description': 'Core service (Node 1)',
-        'ssh_address': '127.0.0.1',
-        'ssh_port': 9022,
-        'username': 'test_user_1',
-        'password': 'test_password_1'
-    }
+    return FIRST_HOST
+
+
+def add_hosts_in_db(db_connection: sqlite3.Connection, *records: dict):
+    """
+    Добавление тестовых записей хостов в базу данных одним запросом и одной транзакцией.
+
+    Args:
+        db_connection (sqlite3.Connection): Подключение к базе данных
+        *records (dict): Словари с тестовыми значениями хостов
+    """
+
+    db_connection.executemany(INSERT_HOST_REQ, [tuple(record[col] for col in HOST_COLUMNS) for record in records])
+    db_connection.commit()
+    # Изменения в обход API не сбрасывают кэш списка хостов
+    all_hosts_cache.invalidate()
 
 
 @pytest.fixture()
@@ -34,12 +69,7 @@ def add_first_host_in_db(db_connection: sqlite3.Connection, first_host: dict):
         first_host (dict): Словарь с тестовыми значениями первого хоста
     """
 
-    cursor = db_connection.cursor()
-    insert_req = ('INSERT INTO hosts '
-                  f'({", ".join(first_host.keys())}) VALUES '
-                  f'({", ".join(map(repr, first_host.values()))})')
-    cursor.execute(insert_req)
-    db_connection.commit()
+    add_hosts_in_db(db_connection, first_host)
 
 
 @pytest.fixture()
@@ -51,32 +81,37 @@ def second_host() -> dict:
         dict: Словарь с тестовыми значениями второго хоста
     """
 
-    return {
-        'name': 'second_service',
-        'description': 'Core service (Node 2)',
-        'ssh_address': '127.0.0.2',
-        'ssh_port': 10022,
-        'username': 'test_user_1',
-        'password': 'test_password_2'
-    }
+    return SECOND_HOST
 
 
 @pytest.fixture()
-def add_second_host_in_db(db_connection: sqlite3.Connection, second_host: dict):
+def add_both_hosts_in_db(db_connection: sqlite3.Connection, first_host: dict, second_host: dict):
     """
-    Фикстура для добавления второй тестовой записи хоста в базу данных.
+    Фикстура для добавления первой и второй тестовых записей хостов в базу данных одной транзакцией.
 
     Args:
         db_connection (sqlite3.Connection): Подключение к базе данных
+        first_host (dict): Словарь с тестовыми значениями первого хоста
         second_host (dict): Словарь с тестовыми значениями второго хоста
     """
 
-    cursor = db_connection.cursor()
-    insert_req = ('INSERT INTO hosts '
-                  f'({", ".join(second_host.keys())}) VALUES '
-                  f'({", ".join(map(repr, second_host.values()))})')
-    cursor.execute(insert_req)
-    db_connection.commit()
+    add_hosts_in_db(db_connection, first_host, second_host)
+
+
+def record_exists_in_db(db_connection: sqlite3.Connection, record: dict) -> bool:
+    """
+    Проверка наличия записи хоста в базе данных одним параметризованным запросом.
+
+    Args:
+        db_connection (sqlite3.Connection): Подключение к базе данных
+        record (dict): Словарь с тестовыми значениями хоста
+
+    Returns:
+        bool: True, если запись с такими значениями есть в базе данных
+    """
+
+    result = db_connection.execute(HOST_EXISTS_REQ, tuple(record[col] for col in HOST_COLUMNS))
+    return bool(result.fetchone()[0])
 
 
 def check_record_in_db(db_connection: sqlite3.Connection, record: dict):
@@ -88,10 +123,7 @@ def check_record_in_db(db_connection: sqlite3.Connection, record: dict):
         record (dict): Словарь с тестовыми значениями хоста которые ожидаются в базе данных
     """
 
-    cursor = db_connection.cursor()
-    select_req = 'SELECT * FROM hosts WHERE ' + ' AND '.join((f'{key}={repr(value)}' for key, value in record.items()))
-    result = cursor.execute(select_req)
-    assert result.fetchone() is not None
+    assert record_exists_in_db(db_connection, record)
 
 
 def check_no_record_in_db(db_connection: sqlite3.Connection, record: dict):
@@ -103,10 +135,7 @@ def check_no_record_in_db(db_connection: sqlite3.Connection, record: dict):
         record (dict): Словарь с тестовыми значениями хоста которые должны отсутствовать в базе данных
     """
 
-    cursor = db_connection.cursor()
-    select_req = 'SELECT * FROM hosts WHERE ' + ' AND '.join((f'{key}={repr(value)}' for key, value in record.items()))
-    result = cursor.execute(select_req)
-    assert result.fetchone() is None
+    assert not record_exists_in_db(db_connection, record)
 
 
 def check_response(response: Response, expected_answer: int = 200):
@@ -142,6 +171,44 @@ def test_post_host(test_client: TestClient, first_host: dict, db_connection: sql
     assert response_data['id'] == 1
 
 
+@pytest.mark.usefixtures('drop_all_data_in_db')
+def test_bulk_post_hosts(test_client: TestClient, first_host: dict, second_host: dict,
+                         db_connection: sqlite3.Connection):
+    """
+    Проверка добавления нескольких новых хостов одним запросом.
+
+    Args:
+        test_client (TestClient): Тестовый клиент API
+        first_host (dict): Словарь с тестовыми значениями первого хоста
+        second_host (dict): Словарь с тестовыми значениями второго хоста
+        db_connection (sqlite3.Connection): Подключение к базе данных
+    """
+
+    response = test_client.post('/api/v1/hosts/bulk', json=[first_host, second_host])
+    check_response(response)
+    check_record_in_db(db_connection, first_host)
+    check_record_in_db(db_connection, second_host)
+    response_data = response.json()
+    assert isinstance(response_data, dict)
+    assert response_data['ids'] == [1, 2]
+
+
+@pytest.mark.usefixtures('drop_all_data_in_db')
+def test_bulk_post_no_hosts(test_client: TestClient, db_connection: sqlite3.Connection):
+    """
+    Проверка добавления пустого списка хостов.
+
+    Args:
+        test_client (TestClient): Тестовый клиент API
+        db_connection (sqlite3.Connection): Подключение к базе данных
+    """
+
+    response = test_client.post('/api/v1/hosts/bulk', json=[])
+    check_response(response)
+    assert response.json() == {'ids': []}
+    assert db_connection.execute('SELECT COUNT(*) FROM hosts').fetchone()[0] == 0
+
+
 @pytest.mark.usefixtures('add_first_host_in_db', 'drop_all_data_in_db')
 def test_get_host(test_client: TestClient, first_host: dict):
     """
@@ -177,7 +244,7 @@ def test_get_nonexisting_host(test_client: TestClient):
     assert response_data['detail'] == 'Host not found'
 
 
-@pytest.mark.usefixtures('add_first_host_in_db', 'add_second_host_in_db', 'drop_all_data_in_db')
+@pytest.mark.usefixtures('add_both_hosts_in_db', 'drop_all_data_in_db')
 def test_get_all_hosts(test_client: TestClient, first_host: dict, second_host: dict):
     """
     Проверка получения информации о всех добавленных хостах.
@@ -270,3 +337,42 @@ def test_update_nonexisting_host(test_client: TestClient, second_host: dict):
     response_data = response.json()
     assert isinstance(response_data, dict)
     assert response_data['detail'] == 'Host not found'
+
+
+@pytest.mark.usefixtures('drop_all_data_in_db')
+def test_get_all_hosts_after_changes(test_client: TestClient, first_host: dict, second_host: dict):
+    """
+    Проверка того, что список всех хостов отражает изменения, сделанные через API.
+
+    Args:
+        test_client (TestClient): Тестовый клиент API
+        first_host (dict): Словарь с тестовыми значениями первого хоста
+        second_host (dict): Словарь с тестовыми значениями второго хоста
+    """
+
+    host_id = test_client.post('/api/v1/hosts', json=first_host).json()['id']
+    response = test_client.get('/api/v1/hosts')
+    check_response(response)
+    assert [host['name'] for host in response.json()] == [first_host['name']]
+
+    check_response(test_client.put(f'/api/v1/hosts/{host_id}', json=second_host))
+    response = test_client.get('/api/v1/hosts')
+    check_response(response)
+    assert [host['name'] for host in response.json()] == [second_host['name']]
+
+    check_response(test_client.delete(f'/api/v1/hosts/{host_id}'))
+    response = test_client.get('/api/v1/hosts')
+    check_response(response)
+    assert response.json() == []
+
+
+def test_dirty_dict(first_host: dict):
+    """
+    Проверка того, что словарь явно заданных полей хоста совпадает с результатом model_dump(exclude_unset=True).
+
+    Args:
+        first_host (dict): Словарь с тестовыми значениями первого хоста
+    """
+
+    for host in (Host(**first_host), Host(host_id=7, **first_host)):
+        assert _dirty_dict(host) == host.model_dump(exclude_unset=True)
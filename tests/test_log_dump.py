@@ -1,10 +1,9 @@
 import os
-import time
-import re
 
 import pytest
 
 from app.dumpers import LogDump
+from tests.conftest import wait_for, captured_log_lines, check_captured_log_file
 
 
 @pytest.mark.usefixtures('test_ssh_server')
@@ -15,18 +14,19 @@ def test_log_dumper():
                      username='test_user', password='test_password',
                      output_file='ping.log', dumped_file='/tmp/ping.log')
     dumper.start()
-    time.sleep(5)
+    wait_for(lambda: captured_log_lines('ping.log') >= 4)
     dumper.stop()
 
-    assert os.path.isfile('ping.log')
-    assert os.path.getsize('ping.log') > 0
-
-    count_ping = 0
-    with open('ping.log', 'rt', encoding='utf8') as log_file:
-        for line in log_file:
-            if re.match(r'64 bytes from 127\.0\.0\.1: seq=\d+ ttl=64 time=\d+\.\d{3} ms', line):
-                count_ping += 1
-            else:
-                assert False, f'Unmatched line: {line}'
-    assert count_ping >= 4
+    check_captured_log_file('ping.log')
     os.remove('ping.log')
+
+
+def test_not_started_dumper_holds_no_descriptors():
+    """Проверка того, что не запущенный сниффер не открывает файловых дескрипторов."""
+
+    fds_before = len(os.listdir('/proc/self/fd'))
+    dumper = LogDump(name='log_dump', address='127.0.0.1', port=10022,
+                     username='test_user', password='test_password',
+                     output_file='ping.log', dumped_file='/tmp/ping.log')
+    assert len(os.listdir('/proc/self/fd')) == fds_before
+    dumper.stop()
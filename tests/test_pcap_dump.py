@@ -1,28 +1,29 @@
 import os
-import time
+from pathlib import Path
 
 import pytest
-from scapy.all import rdpcap, ICMP  # pylint: disable=no-name-in-module
 
 from app.dumpers import PCAPDump
+from tests.conftest import wait_for, count_ping_requests, captured_ping_requests
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_pcap_dumper():
-    """Проверка работы удаленного траффика."""
+def test_pcap_dumper(tmp_path: Path):
+    """
+    Проверка работы удаленного траффика.
 
+    Args:
+        tmp_path (Path): Временный каталог теста
+    """
+
+    output_file = str(tmp_path / 'test_dump.pcap')
     dumper = PCAPDump(name='pcap_dump', address='127.0.0.1', port=10022,
-                      username='test_user', password='test_password', output_file='test_dump.pcap')
+                      username='test_user', password='test_password', output_file=output_file)
     dumper.start()
-    time.sleep(5)
+    wait_for(lambda: captured_ping_requests(output_file, 4) >= 4)
     dumper.stop()
 
-    assert os.path.isfile('test_dump.pcap')
-    assert os.path.getsize('test_dump.pcap') > 0
-
-    pcap = rdpcap('test_dump.pcap')
-    assert len(pcap) > 0
-    ping_requests = [pkt for pkt in pcap if ICMP in pkt and pkt.payload['ICMP'].type == 8]
-    assert len(ping_requests) >= 4
+    assert os.path.isfile(output_file)
+    assert os.path.getsize(output_file) > 0
 
-    os.remove('test_dump.pcap')
+    assert count_ping_requests(output_file, 4) >= 4
@@ -1,11 +1,27 @@
 import os
-from subprocess import Popen, PIPE
+import sys
+import subprocess
+from contextlib import suppress
 
 import pytest
 import paramiko
 
 from app.ssh_conn_mngr import SSHConnectionManager
 
+# Адреса тестовых SSH серверов и состояние соединения в формате /proc/net/tcp
+SSH_SERVER_ADDRESSES = ('0100007F:2726', '0100007F:2727')
+TCP_ESTABLISHED = '01'
+
+
+@pytest.fixture(autouse=True)
+def reset_ssh_connection_manager():
+    """
+    Фикстура сбрасывающая экземпляр менеджера SSH подключений перед каждым тестом,
+    чтобы результат теста не зависел от порядка запуска.
+    """
+
+    SSHConnectionManager._instance = None  # pylint: disable=protected-access
+
 
 @pytest.fixture()
 def ssh_connection_manager() -> SSHConnectionManager:
@@ -23,17 +39,27 @@ def ssh_connection_manager() -> SSHConnectionManager:
 
 def get_all_connections() -> list:
     """
-    Получить все активные SSH-соединения по портам 10022 и 10023.
+    Получить все активные SSH-соединения текущего процесса по портам 10022 и 10023.
+    Соединения читаются из /proc/net/tcp и отбираются по inode сокетов из /proc/self/fd.
 
     Returns:
         list: Список содержащий всем активные SSH-соединения
     """
+
+    socket_inodes = set()
+    for fd_name in os.listdir('/proc/self/fd'):
+        with suppress(OSError):
+            link = os.readlink(f'/proc/self/fd/{fd_name}')
+            if link.startswith('socket:['):
+                socket_inodes.add(link[8:-1])
+
     connections = []
-    with Popen(['lsof', '-a', '-iTCP', '-p', str(os.getpid()), '-n'], stdout=PIPE, encoding='utf8') as proc:
-        for line in proc.stdout:
-            if '->127.0.0.1:10022 (ESTABLISHED)' in line:
-                connections.append(line)
-            elif '->127.0.0.1:10023 (ESTABLISHED)' in line:
+    with open('/proc/self/net/tcp', 'rt', encoding='ascii') as tcp_table:
+        next(tcp_table)
+        for line in tcp_table:
+            fields = line.split()
+            # remote address 127.0.0.1:10022 или 127.0.0.1:10023, состояние ESTABLISHED, inode сокета процесса
+            if fields[2] in SSH_SERVER_ADDRESSES and fields[3] == TCP_ESTABLISHED and fields[9] in socket_inodes:
                 connections.append(line)
     return connections
 
@@ -55,11 +81,6 @@ def check_has_not_connections():
 def test_constructor():
     """Проверка того что создается только один менеджер SSH подключений."""
 
-    # pylint: disable-next=protected-access
-    if SSHConnectionManager._instance is not None:
-        # pylint: disable-next=protected-access
-        SSHConnectionManager._instance = None
-
     manager1 = SSHConnectionManager('test_ssh_conn_manager_1')
     manager2 = SSHConnectionManager('test_ssh_conn_manager_2')
     assert manager1 is manager2
@@ -214,3 +235,16 @@ def test_destroy_all_connections(ssh_connection_manager: SSHConnectionManager):
         ssh_connection_manager.release_connection(first_lease_id)
     with pytest.raises(LookupError):
         ssh_connection_manager.release_connection(second_lease_id)
+
+
+def test_destroy_all_connections_unregisters_atexit():
+    """
+    Проверка того, что после явного закрытия всех подключений
+    обработчик atexit менеджера не закрывает их повторно при завершении интерпретатора.
+    """
+
+    script = ('import logging; from app.ssh_conn_mngr import SSHConnectionManager; '
+              'logging.basicConfig(level=logging.INFO); '
+              'SSHConnectionManager("ssh_conn_manager").destroy_all_connections()')
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    assert result.stderr.count('Destroy all connections') == 1
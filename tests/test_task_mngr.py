@@ -1,12 +1,19 @@
 import os
+import logging
 import time
-import re
+import signal
+import socket
+import threading
+from contextlib import suppress
+from pathlib import Path
 
 import pytest
-from scapy.all import rdpcap, ICMP  # pylint: disable=no-name-in-module
+import paramiko
 
-from app.task_mngr import TaskManager
+from app.task_mngr import TaskManager, TaskManagerCommand, TaskManagerResult, PipeLogHandler, PipeLogListener, context
 from app.models.task import Task
+from tests.conftest import wait_for, file_not_empty, count_ping_requests, captured_ping_requests, captured_log_lines, \
+    check_captured_log_file
 
 
 @pytest.fixture(scope='session')
@@ -26,91 +33,127 @@ def task_manager() -> TaskManager:
     manager.stop()
 
 
-@pytest.fixture(autouse=True)
-def remove_artifacts():
+@pytest.fixture()
+def stalled_ssh_server() -> int:
     """
-    Фикстура для удаления артифактов теста.
+    Фикстура TCP сервера, отправляющего SSH баннер и не отвечающего на дальнейший обмен ключами.
+
+    Yields:
+        Iterator[int]: Порт сервера
+    """
+
+    server = socket.create_server(('127.0.0.1', 0))
+    clients = []
+
+    def serve():
+        with suppress(OSError):
+            while True:
+                client, _ = server.accept()
+                clients.append(client)
+                client.sendall(b'SSH-2.0-OpenSSH_8.9\r\n')
+
+    serve_thread = threading.Thread(target=serve, daemon=True)
+    serve_thread.start()
+
+    yield server.getsockname()[1]
+
+    # Прерываем ожидание accept в потоке сервера
+    with suppress(OSError):
+        server.shutdown(socket.SHUT_RDWR)
+    server.close()
+    serve_thread.join()
+    for client in clients:
+        client.close()
+
+
+@pytest.fixture()
+def pcap_path(tmp_path: Path) -> str:
+    """
+    Фикстура возвращающая путь к файлу дампа траффика во временном каталоге теста.
+
+    Args:
+        tmp_path (Path): Временный каталог теста
+
+    Returns:
+        str: Путь к файлу дампа траффика
     """
 
-    yield
+    return str(tmp_path / 'test_dump.pcap')
 
-    for filename in ('test_dump.pcap', 'ping.log'):
-        try:
-            os.remove(filename)
-        except FileNotFoundError:
-            pass
 
+@pytest.fixture()
+def log_path(tmp_path: Path) -> str:
+    """
+    Фикстура возвращающая путь к файлу дампа логов во временном каталоге теста.
 
-def check_captured_pcap_file():
-    """Проверка файла 'test_dump.pcap'."""
+    Args:
+        tmp_path (Path): Временный каталог теста
 
-    assert os.path.isfile('test_dump.pcap')
-    assert os.path.getsize('test_dump.pcap') > 0
+    Returns:
+        str: Путь к файлу дампа логов
+    """
 
-    pcap = rdpcap('test_dump.pcap')
-    assert len(pcap) > 0
-    ping_requests = [pkt for pkt in pcap if ICMP in pkt and pkt.payload['ICMP'].type == 8]
-    assert len(ping_requests) >= 4
+    return str(tmp_path / 'ping.log')
 
 
-def check_captured_log_file():
-    """Проверка файла 'ping.log'."""
+def check_captured_pcap_file(filename: str):
+    """
+    Проверка файла дампа траффика.
 
-    assert os.path.isfile('ping.log')
-    assert os.path.getsize('ping.log') > 0
+    Args:
+        filename (str): Путь к файлу дампа траффика
+    """
 
-    count_ping = 0
-    with open('ping.log', 'rt', encoding='utf8') as log_file:
-        for line in log_file:
-            if re.match(r'64 bytes from 127\.0\.0\.1: seq=\d+ ttl=64 time=\d+\.\d{3} ms', line):
-                count_ping += 1
-            else:
-                assert False, f'Unmatched line: {line}'
-    assert count_ping >= 4
+    assert os.path.isfile(filename)
+    assert os.path.getsize(filename) > 0
+
+    assert count_ping_requests(filename, 4) >= 4
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_start_pcap_dump(task_manager: TaskManager):
+def test_start_pcap_dump(task_manager: TaskManager, pcap_path: str):
     """
     Проверка запуска удаленного сниффера траффика.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        pcap_path (str): Путь к файлу дампа траффика
     """
 
     task_info = task_manager.start_pcap_dump(address='127.0.0.1', port=10022,
                                              username='test_user', password='test_password',
-                                             output_file='test_dump.pcap')
+                                             output_file=pcap_path)
     assert isinstance(task_info, Task)
     assert task_info.name.endswith(f'pcap_{task_info.task_id}')
     assert task_info.task_type == 'pcap_dump'
     assert task_info.is_alive is True
 
-    time.sleep(5)
+    wait_for(lambda: captured_ping_requests(pcap_path, 4) >= 4)
 
     task_manager.stop_task(task_info.task_id)
-    check_captured_pcap_file()
+    check_captured_pcap_file(pcap_path)
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_get_task_info(task_manager: TaskManager):
+def test_get_task_info(task_manager: TaskManager, pcap_path: str):
     """
     Проверка получения информации о запущенной задаче.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        pcap_path (str): Путь к файлу дампа траффика
     """
 
     task_info = task_manager.start_pcap_dump(address='127.0.0.1', port=10022,
                                              username='test_user', password='test_password',
-                                             output_file='test_dump.pcap')
+                                             output_file=pcap_path)
     assert isinstance(task_info, Task)
     assert task_info.name.endswith(f'pcap_{task_info.task_id}')
     assert task_info.task_type == 'pcap_dump'
     assert task_info.is_alive is True
     task_id = task_info.task_id
 
-    time.sleep(1)
+    wait_for(lambda: file_not_empty(pcap_path))
 
     task_info = task_manager.get_task_info(task_id)
     assert isinstance(task_info, Task)
@@ -141,49 +184,51 @@ def test_get_task_info_non_existing_task(task_manager: TaskManager):
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_start_log_dump(task_manager: TaskManager):
+def test_start_log_dump(task_manager: TaskManager, log_path: str):
     """
     Проверка запуска удаленного сниффера логов.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        log_path (str): Путь к файлу дампа логов
     """
 
     task_info = task_manager.start_log_dump(address='127.0.0.1', port=10022,
                                             username='test_user', password='test_password',
-                                            output_file='ping.log', dumped_file='/tmp/ping.log')
+                                            output_file=log_path, dumped_file='/tmp/ping.log')
     assert isinstance(task_info, Task)
     assert task_info.name.endswith(f'log_{task_info.task_id}')
     assert task_info.task_type == 'log_dump'
     assert task_info.is_alive is True
 
-    time.sleep(5)
+    wait_for(lambda: captured_log_lines(log_path) >= 4)
 
     task_manager.stop_task(task_info.task_id)
-    check_captured_log_file()
+    check_captured_log_file(log_path)
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_stop_task(task_manager: TaskManager):
+def test_stop_task(task_manager: TaskManager, log_path: str):
     """
     Проверка завершения выполнения задачи.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        log_path (str): Путь к файлу дампа логов
     """
 
     task_info = task_manager.start_log_dump(address='127.0.0.1', port=10022,
                                             username='test_user', password='test_password',
-                                            output_file='ping.log', dumped_file='/tmp/ping.log')
+                                            output_file=log_path, dumped_file='/tmp/ping.log')
 
-    time.sleep(5)
+    wait_for(lambda: captured_log_lines(log_path) >= 4)
 
     task_info = task_manager.stop_task(task_info.task_id)
     assert isinstance(task_info, Task)
     assert task_info.name.endswith(f'log_{task_info.task_id}')
     assert task_info.task_type == 'log_dump'
     assert task_info.is_alive is False
-    check_captured_log_file()
+    check_captured_log_file(log_path)
 
 
 def test_stop_non_existing_task(task_manager: TaskManager):
@@ -200,96 +245,268 @@ def test_stop_non_existing_task(task_manager: TaskManager):
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_start_two_task(task_manager: TaskManager):
+def test_start_two_task(task_manager: TaskManager, pcap_path: str, log_path: str):
     """
     Проверка работы двух задач одновременно.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        pcap_path (str): Путь к файлу дампа траффика
+        log_path (str): Путь к файлу дампа логов
     """
 
     log_dump_task_info = task_manager.start_log_dump(address='127.0.0.1', port=10022,
                                                      username='test_user', password='test_password',
-                                                     output_file='ping.log', dumped_file='/tmp/ping.log')
+                                                     output_file=log_path, dumped_file='/tmp/ping.log')
     assert isinstance(log_dump_task_info, Task)
     assert log_dump_task_info.is_alive is True
 
     pcap_dump_task_info = task_manager.start_pcap_dump(address='127.0.0.1', port=10022,
                                                        username='test_user', password='test_password',
-                                                       output_file='test_dump.pcap')
+                                                       output_file=pcap_path)
     assert isinstance(pcap_dump_task_info, Task)
     assert pcap_dump_task_info.is_alive is True
 
-    time.sleep(5)
+    wait_for(lambda: captured_log_lines(log_path) >= 4 and captured_ping_requests(pcap_path, 4) >= 4)
 
     task_manager.stop_task(log_dump_task_info.task_id)
     task_manager.stop_task(pcap_dump_task_info.task_id)
 
-    check_captured_log_file()
-    check_captured_pcap_file()
+    check_captured_log_file(log_path)
+    check_captured_pcap_file(pcap_path)
+
+
+def task_summary(task: Task) -> tuple:
+    """
+    Сводка задачи для сравнения списка задач одним сравнением.
+    Имя задачи сводится к признаку того, что оно оканчивается на тип и идентификатор задачи.
+
+    Args:
+        task (Task): Информация о задаче
+
+    Returns:
+        tuple: Тип объекта, тип задачи, идентификатор, признак работы и признак корректного имени
+    """
+
+    name_matches = isinstance(task.name, str) and task.name.endswith(f'{task.task_type.split("_")[0]}_{task.task_id}')
+    return type(task), task.task_type, task.task_id, task.is_alive, name_matches
 
 
 @pytest.mark.usefixtures('test_ssh_server')
-def test_get_all_tasks(task_manager: TaskManager):
+def test_get_all_tasks(task_manager: TaskManager, pcap_path: str, log_path: str):
     """
     Проверка получения информации о всех запущенных задачах.
 
     Args:
         task_manager (TaskManager): Менеджер задач
+        pcap_path (str): Путь к файлу дампа траффика
+        log_path (str): Путь к файлу дампа логов
     """
 
     log_dump_task_id = task_manager.start_log_dump(address='127.0.0.1', port=10022,
                                                    username='test_user', password='test_password',
-                                                   output_file='ping.log', dumped_file='/tmp/ping.log').task_id
+                                                   output_file=log_path, dumped_file='/tmp/ping.log').task_id
+    log_dump_summary = (Task, 'log_dump', log_dump_task_id, True, True)
     tasks = task_manager.get_all_tasks()
     assert isinstance(tasks, list)
-    assert len(tasks) == 1
-    log_dump_task_info = tasks[0]
-    assert isinstance(log_dump_task_info, Task)
-    assert isinstance(log_dump_task_info.name, str)
-    assert log_dump_task_info.name.endswith(f'log_{log_dump_task_id}')
-    assert log_dump_task_info.task_type == 'log_dump'
-    assert log_dump_task_info.task_id == log_dump_task_id
-    assert log_dump_task_info.is_alive is True
+    assert [task_summary(task) for task in tasks] == [log_dump_summary]
 
-    time.sleep(1)
+    wait_for(lambda: file_not_empty(log_path))
 
     pcap_dump_task_id = task_manager.start_pcap_dump(address='127.0.0.1', port=10022,
                                                      username='test_user', password='test_password',
-                                                     output_file='test_dump.pcap').task_id
+                                                     output_file=pcap_path).task_id
+    pcap_dump_summary = (Task, 'pcap_dump', pcap_dump_task_id, True, True)
     tasks = task_manager.get_all_tasks()
     assert isinstance(tasks, list)
-    assert len(tasks) == 2
-    log_dump_task_info = tasks[0]
-    assert isinstance(log_dump_task_info, Task)
-    assert isinstance(log_dump_task_info.name, str)
-    assert log_dump_task_info.name.endswith(f'log_{log_dump_task_id}')
-    assert log_dump_task_info.task_id == log_dump_task_id
-    assert log_dump_task_info.task_type == 'log_dump'
-    assert log_dump_task_info.is_alive is True
-    pcap_dump_task_info = tasks[1]
-    assert isinstance(pcap_dump_task_info, Task)
-    assert isinstance(pcap_dump_task_info.name, str)
-    assert pcap_dump_task_info.name.endswith(f'pcap_{pcap_dump_task_id}')
-    assert pcap_dump_task_info.task_id == pcap_dump_task_id
-    assert pcap_dump_task_info.task_type == 'pcap_dump'
-    assert pcap_dump_task_info.is_alive is True
+    assert [task_summary(task) for task in tasks] == [log_dump_summary, pcap_dump_summary]
 
-    time.sleep(1)
+    wait_for(lambda: file_not_empty(pcap_path))
 
     task_manager.stop_task(log_dump_task_id)
     tasks = task_manager.get_all_tasks()
     assert isinstance(tasks, list)
-    assert len(tasks) == 1
-    pcap_dump_task_info = tasks[0]
-    assert isinstance(pcap_dump_task_info, Task)
-    assert isinstance(pcap_dump_task_info.name, str)
-    assert pcap_dump_task_info.name.endswith(f'pcap_{pcap_dump_task_id}')
-    assert pcap_dump_task_info.task_id == pcap_dump_task_id
-    assert pcap_dump_task_info.task_type == 'pcap_dump'
-    assert pcap_dump_task_info.is_alive is True
+    assert [task_summary(task) for task in tasks] == [pcap_dump_summary]
 
     task_manager.stop_task(pcap_dump_task_id)
     tasks = task_manager.get_all_tasks()
     assert isinstance(tasks, list)
     assert len(tasks) == 0
+
+
+def test_batch(task_manager: TaskManager):
+    """
+    Проверка выполнения нескольких команд за один обмен с субпроцессом.
+
+    Args:
+        task_manager (TaskManager): Менеджер задач
+    """
+
+    results = task_manager.batch([TaskManagerCommand(name='get_all_tasks'),
+                                  TaskManagerCommand(name='get_task_info', args=('yhsf76ha',)),
+                                  TaskManagerCommand(name='unknown_command')])
+    assert isinstance(results, list)
+    assert len(results) == 3
+    assert isinstance(results[0], list)
+    assert isinstance(results[1], LookupError)
+    assert str(results[1]) == 'Task with id="yhsf76ha" not found in task list.'
+    assert isinstance(results[2], Exception)
+    assert str(results[2]) == 'Unknown command: "unknown_command"'
+
+
+def test_start_dump_unreachable_host(task_manager: TaskManager, log_path: str):
+    """
+    Проверка того, что ошибка подключения к хосту возвращается при запуске задачи,
+    а задача не добавляется в список задач.
+
+    Args:
+        task_manager (TaskManager): Менеджер задач
+        log_path (str): Путь к файлу дампа логов
+    """
+
+    tasks_before = task_manager.get_all_tasks()
+    with pytest.raises(OSError):
+        task_manager.start_log_dump(address='127.0.0.1', port=10099,
+                                    username='test_user', password='test_password',
+                                    output_file=log_path, dumped_file='/tmp/ping.log')
+    assert task_manager.get_all_tasks() == tasks_before
+
+
+def test_rpc_after_subprocess_terminated():
+    """
+    Проверка того, что команда к аварийно завершенному субпроцессу сразу завершается ошибкой,
+    а не ожидает весь таймаут.
+    """
+
+    manager = TaskManager('terminated_task_mngr', timeout=30)
+    manager.start()
+    manager._process.kill()  # pylint: disable=protected-access
+    manager._process.join()  # pylint: disable=protected-access
+
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        manager.get_all_tasks()
+    assert time.monotonic() - started < 5
+
+    manager.stop()
+
+
+@pytest.mark.usefixtures('test_ssh_server')
+def test_rpc_after_timed_out_call(log_path: str):
+    """
+    Проверка того, что запоздавший ответ на вызов, завершившийся по таймауту,
+    не возвращается следующему вызову, а просроченная команда запуска задачи не выполняется.
+
+    Args:
+        log_path (str): Путь к файлу дампа логов
+    """
+
+    manager = TaskManager('timed_out_task_mngr', timeout=1)
+    manager.start()
+    # Приостановленный субпроцесс получит команду только после истечения таймаута вызова
+    os.kill(manager._process.pid, signal.SIGSTOP)  # pylint: disable=protected-access
+    try:
+        with pytest.raises(TimeoutError):
+            manager.start_log_dump(address='127.0.0.1', port=10022,
+                                   username='test_user', password='test_password',
+                                   output_file=log_path, dumped_file='/tmp/ping.log')
+    finally:
+        os.kill(manager._process.pid, signal.SIGCONT)  # pylint: disable=protected-access
+    manager.timeout = 10
+    assert manager.get_all_tasks() == []
+
+    manager.stop()
+
+
+@pytest.mark.usefixtures('test_ssh_server')
+def test_task_started_after_timed_out_call(log_path: str):
+    """
+    Проверка того, что для задачи из запоздавшего ответа на запуск создается команда ее остановки.
+
+    Args:
+        log_path (str): Путь к файлу дампа логов
+    """
+
+    manager = TaskManager('late_start_task_mngr')
+    manager.start()
+    task = manager.start_log_dump(address='127.0.0.1', port=10022,
+                                  username='test_user', password='test_password',
+                                  output_file=log_path, dumped_file='/tmp/ping.log')
+    # Подключение ограничено таймаутом вызова, поэтому запоздавший ответ с задачей имитируется
+    manager._timed_out_calls[0] = 'start_log_dump'  # pylint: disable=protected-access
+    stop_command = manager._handle_stale_result(TaskManagerResult(task, 0))  # pylint: disable=protected-access
+    assert (stop_command.name, stop_command.args) == ('stop_task', (task.task_id,))
+
+    manager.stop()
+
+
+def test_start_dump_stalled_ssh_server(stalled_ssh_server: int, log_path: str):
+    """
+    Проверка того, что подключение к серверу, зависшему после отправки баннера,
+    завершается ошибкой в субпроцессе до истечения таймаута вызова.
+
+    Args:
+        stalled_ssh_server (int): Порт зависающего сервера
+        log_path (str): Путь к файлу дампа логов
+    """
+
+    manager = TaskManager('stalled_task_mngr', timeout=2)
+    manager.start()
+    started = time.monotonic()
+    with pytest.raises(paramiko.SSHException):
+        manager.start_log_dump(address='127.0.0.1', port=stalled_ssh_server,
+                               username='test_user', password='test_password',
+                               output_file=log_path, dumped_file='/tmp/ping.log')
+    assert time.monotonic() - started < manager.timeout
+    assert manager.get_all_tasks() == []
+
+    manager.stop()
+
+
+def test_pipe_log_handler_formats_on_emit():
+    """
+    Проверка того, что буферизованные лог записи форматируются в момент логирования
+    и передаются в родительский процесс одним списком.
+    """
+
+    reader, writer = context.Pipe(duplex=False)
+    handler = PipeLogHandler(writer, flush_interval=10)
+    logger = logging.getLogger('test_pipe_log_handler')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    connections = {'first': 1}
+    logger.debug('Open connections: %r', connections)
+    logger.info('Second record')
+    connections.clear()
+    assert not reader.poll(0.2)
+
+    logger.removeHandler(handler)
+    handler.close()
+    thread_name = threading.current_thread().name
+    assert [(name, level, thread, msg) for name, level, _, thread, msg in reader.recv()] == \
+        [('test_pipe_log_handler', logging.DEBUG, thread_name, "Open connections: {'first': 1}"),
+         ('test_pipe_log_handler', logging.INFO, thread_name, 'Second record')]
+    reader.close()
+    writer.close()
+
+
+def test_pipe_log_listener_keeps_record_attributes():
+    """
+    Проверка того, что восстановленная из канала лог запись сохраняет время создания и имя потока.
+    """
+
+    reader, writer = context.Pipe(duplex=False)
+    handler = PipeLogHandler(writer)
+    record = logging.makeLogRecord({'name': 'test_pipe_log_listener', 'levelno': logging.ERROR,
+                                    'levelname': 'ERROR', 'msg': 'Record', 'created': 1000000000.25,
+                                    'threadName': 'dumper_thread'})
+    handler.handle(record)
+    handler.close()
+
+    listener = PipeLogListener(reader, writer, logging.getLogger('test_pipe_log_listener'))
+    restored = listener.dequeue(True)
+    assert (restored.created, restored.msecs, restored.threadName, restored.getMessage()) == \
+        (1000000000.25, 250.0, 'dumper_thread', 'Record')
+    reader.close()
+    writer.close()